@@ -0,0 +1,100 @@
+"""Sampling the tank state over Modbus.
+
+A TankSample holds the command coil, the pump input and the concentration
+registers, with the time the sample was taken. TankSampler takes one with
+one of three strategies:
+
+    sequential  read registers, coils and discrete inputs one after another
+                (three round trips, the original client behaviour)
+    concurrent  issue the three reads at once and wait for all of them
+    image       one read_holding_registers spanning the coil, the input and
+                the registers. This relies on the tank serving coils,
+                discrete inputs and holding registers from one shared block,
+                as waterTank.py does.
+
+The addresses come from a register map, by default the waterTank.py layout;
+the "registerMap" section of the config can override any of them.
+"""
+import asyncio
+from collections import namedtuple
+
+from pymodbus import ModbusException
+
+from sim_clock import RealClock
+
+
+TankSample = namedtuple('TankSample', ['timestamp', 'coil', 'hcl_input', 'registers'])
+
+ACQUISITION_MODES = ('sequential', 'concurrent', 'image')
+
+DEFAULT_REGISTER_MAP = {
+    'slave': 1,
+    'coilAddress': 0,
+    'inputAddress': 2,
+    'regAddress': 4,
+    'regCount': 2,
+}
+
+
+def make_register_map(overrides=None):
+    registerMap = dict(DEFAULT_REGISTER_MAP)
+    if overrides:
+        registerMap.update(overrides)
+    return registerMap
+
+
+def checked(rr):
+    if rr.isError():
+        raise ModbusException("read failed: {}".format(rr))
+    return rr
+
+
+class TankSampler:
+    def __init__(self, client, registerMap=None, mode='sequential', clock=None):
+        assert mode in ACQUISITION_MODES, "acquisition should be one of {}".format(ACQUISITION_MODES)
+        self.client = client
+        self.registerMap = make_register_map(registerMap)
+        self.mode = mode
+        self.clock = clock if clock is not None else RealClock()
+
+        # window of the single image read
+        addresses = (self.registerMap['coilAddress'], self.registerMap['inputAddress'], self.registerMap['regAddress'])
+        self.image_start = min(addresses)
+        self.image_count = max(self.registerMap['coilAddress'] + 1, self.registerMap['inputAddress'] + 1,
+                               self.registerMap['regAddress'] + self.registerMap['regCount']) - self.image_start
+
+    async def sample(self):
+        if self.mode == 'image':
+            coil, hcl_input, registers = await self._read_image()
+        elif self.mode == 'concurrent':
+            coil, hcl_input, registers = await asyncio.gather(self._read_coil(), self._read_input(), self._read_registers())
+        else:
+            registers = await self._read_registers()
+            coil = await self._read_coil()
+            hcl_input = await self._read_input()
+        return TankSample(self.clock.now(), coil, hcl_input, registers)
+
+    async def _read_registers(self):
+        rr = checked(await self.client.read_holding_registers(
+            self.registerMap['regAddress'], self.registerMap['regCount'], slave=self.registerMap['slave']))
+        return rr.registers
+
+    async def _read_coil(self):
+        rr = checked(await self.client.read_coils(self.registerMap['coilAddress'], 1, slave=self.registerMap['slave']))
+        return rr.bits[0]
+
+    async def _read_input(self):
+        rr = checked(await self.client.read_discrete_inputs(self.registerMap['inputAddress'], 1, slave=self.registerMap['slave']))
+        return rr.bits[0]
+
+    async def _read_image(self):
+        rr = checked(await self.client.read_holding_registers(
+            self.image_start, self.image_count, slave=self.registerMap['slave']))
+        image = rr.registers
+        regStart = self.registerMap['regAddress'] - self.image_start
+        return (bool(image[self.registerMap['coilAddress'] - self.image_start]),
+                bool(image[self.registerMap['inputAddress'] - self.image_start]),
+                image[regStart:regStart + self.registerMap['regCount']])
+
+    async def write_coil(self, value):
+        return await self.client.write_coil(self.registerMap['coilAddress'], value, slave=self.registerMap['slave'])
@@ -0,0 +1,67 @@
+"""Poll the tank only as often as the control loop needs.
+
+The client acts on a sample only when the H concentration has crossed a
+setpoint in the direction the pump is driving it: above the high setpoint
+while the pump is on, below the low one while it is off. Since the tank
+model is exact, TankStateClass can tell how many tank updates away that
+crossing is, and AdaptivePollPolicy skips the polls before it. The client
+then still sees the crossing at the same update a poll every update would
+have, so the control is unchanged; far from the setpoints most polls (and
+their Modbus requests) disappear.
+
+A measurement the model did not predict (any residual) may mean an attack
+or a disturbance, so after one the policy polls at the minimum period until
+the residuals are gone.
+
+Periods are counted in tank updates (update * 10 seconds each), between
+"minPollPeriods" and "maxPollPeriods" of the config.
+
+usage::
+
+    policy = AdaptivePollPolicy(inputRate, dilutionRate, update, low, high, minPeriods=1, maxPeriods=10)
+    periods = policy.next_periods(registers, cmd, residual)
+    await scheduler.wait(periods)
+    tankState.advance_state(periods, inputRate, dilutionRate, update)
+"""
+from tank_state import TankStateClass
+
+
+class AdaptivePollPolicy:
+    def __init__(self, inputRate, dilutionRate, updateRate, low, high, minPeriods=1, maxPeriods=10):
+        assert 1 <= minPeriods <= maxPeriods, "poll periods should satisfy 1 <= min <= max"
+        assert low < high, "low setpoint should be below the high one"
+        self.inputRate = inputRate
+        self.dilutionRate = dilutionRate
+        self.updateRate = updateRate
+        self.low = low
+        self.high = high
+        self.minPeriods = minPeriods
+        self.maxPeriods = maxPeriods
+
+        self.state = TankStateClass()       # scratch state for the predictions
+        self.polls = 0
+        self.periods = 0                    # tank updates covered by those polls
+
+    def next_periods(self, registers, cmd, residual=0):
+        """Tank updates until the next poll, for the measured registers and the pump command now in force."""
+        if residual != 0:
+            periods = self.minPeriods
+        else:
+            self.state.set_client_cmd_coil(1 if cmd else 0)
+            self.state.set_h_concentration(registers[0])
+            self.state.set_hcl_concentration(registers[1])
+            if cmd:
+                steps = self.state.predict_steps_to_threshold(self.high, self.inputRate, self.dilutionRate, self.updateRate,
+                                                              above=True, horizon=self.maxPeriods)
+            else:
+                steps = self.state.predict_steps_to_threshold(self.low, self.inputRate, self.dilutionRate, self.updateRate,
+                                                              above=False, horizon=self.maxPeriods)
+            periods = self.maxPeriods if steps is None else min(max(steps, self.minPeriods), self.maxPeriods)
+
+        self.polls += 1
+        self.periods += periods
+        return periods
+
+    def savings(self):
+        """Fraction of the polls of a fixed one-update period that were skipped."""
+        return 1.0 - self.polls / self.periods if self.periods else 0.0
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""How fast and how reliably the detectors catch attacks, without sockets.
+
+The tank (TankStateClass behind a minimal Modbus server), the MITM
+(MITMModbusProxy.handle_request/handle_response and its transforms) and the
+client loop of client_async.py (sequential acquisition, twin or Kalman
+predictor, setpoint control) exchange real Modbus TCP frames in one process,
+on a ManualClock that advances one tank update per poll. Every trial of a
+scenario has its own seed (initial tank state, attack start, sensor noise),
+so a run is reproducible exactly.
+
+Scenarios:
+
+    none      no attack, only false alarms count
+    mitm      the MITM of mitm_async.py, triggered at the attack start
+    bias      a constant offset on the H register
+    ramp      an offset on the H register growing linearly in time
+    freeze    the H and HCl registers stuck at their values at the start
+    replay    the registers of the RECORD seconds before the start, looped
+
+Reported per scenario and detector:
+
+    detected        trials with an alarm after the attack started
+    ttd             time to detect, median and max over the detected trials
+    deviation       sum of |H residual| from the start to the detection (or
+                    the end), max over the trials
+    error           largest |true H - reported H| before detection
+    fa/h            alarm onsets before the attack start per simulated hour
+
+and the simulated samples per second of the whole run.
+
+usage::
+
+    benchmark.py [--config dt.json] [--scenarios none mitm bias] [--trials 5] [--seed 0]
+                 [--duration 3600] [--warmup 600] [--noise 0] [--output bench.json]
+                 [--baseline bench.json] [--tolerance 0.25]
+
+--baseline compares with an earlier --output and exits with status 1 if any
+detector got worse or the throughput dropped by more than --tolerance.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+
+from tank_state import *
+from detector import *
+from dt_config import ConfigWatcher
+from kalman import KalmanPredictor
+from sim_clock import ManualClock
+import mitm_async
+from mitm_async import MITMModbusProxy, TANK_COIL_ADDRESS, TANK_INPUT_ADDRESS, TANK_REG_ADDRESS
+
+
+SCENARIOS = ('none', 'mitm', 'bias', 'ramp', 'freeze', 'replay')
+DETECTORS = ('stateless', 'stateful', 'ewma', 'cusum2', 'page-hinkley', 'chi2')
+
+BIAS = 500              # H register offset of the bias attack
+RAMP = 2.0              # H register offset per second of the ramp attack
+RECORD = 120.0          # seconds of registers the replay attack loops
+
+hConcentrationThresholdHigh = 11220.2 # this should be roughly a pH of 6.95
+hConcentrationThresholdLow = 8912.5 # pH of 7.05
+
+MBAP_REQUEST = struct.Struct('>HHHBBHH')   # transaction, protocol, length, unit, function code, address, value
+
+
+class TankServer:
+    """The waterTank.py datastore layout, answering Modbus TCP request frames."""
+    def __init__(self, tankState, proxy, noise=0.0, rng=None):
+        self.tankState = tankState
+        self.proxy = proxy          # for its frame parsing and building
+        self.noise = noise
+        self.rng = rng
+
+    def measured(self):
+        h, hcl = self.tankState.get_concentrations()
+        if self.noise > 0.0:
+            h += int(round(self.rng.gauss(0.0, self.noise)))
+            hcl += int(round(self.rng.gauss(0.0, self.noise)))
+        return [min(max(h, 0), 0xFFFF), min(max(hcl, 0), 0xFFFF)]
+
+    def handle(self, frame):
+        request = self.proxy.parse_data(frame)
+        fc = request['function_code']
+        response = {'transaction_id': request['transaction_id'], 'protocol_id': request['protocol_id'],
+                    'unit_id': request['unit_id'], 'function_code': fc}
+        if fc == 3:
+            block = {TANK_COIL_ADDRESS: self.tankState.coils[CMD], TANK_INPUT_ADDRESS: self.tankState.inputs[HCL]}
+            block[TANK_REG_ADDRESS], block[TANK_REG_ADDRESS + 1] = self.measured()
+            start = request['register_addr']
+            response['register_data'] = [block.get(a, 0) for a in range(start, start + request['quantity_of_registers'])]
+            response['byte_count'] = 2 * request['quantity_of_registers']
+        elif fc in (1, 2):
+            value = self.tankState.coils[CMD] if fc == 1 else self.tankState.inputs[HCL]
+            response['coils'] = [bool(value)]
+            response['byte_count'] = 1
+        elif fc == 5:
+            self.tankState.set_client_cmd_coil(1 if request['coil_value'] == 0xFF00 else 0)
+            response['coil_addr'] = request['coil_addr']
+            response['coil_value'] = request['coil_value'].to_bytes(2, byteorder='big')
+        response['length'] = 2 + (4 if fc == 5 else 1 + response['byte_count'])
+        return self.proxy.create_new_response(response)
+
+
+class RegisterAttack:
+    """Rewrites the H and HCl registers of read responses on their way to the client."""
+    def __init__(self, kind, start):
+        self.kind = kind
+        self.start = start
+        self.frozen = None
+        self.recorded = []
+
+    def spoof(self, registers, t):
+        if t < self.start:
+            if self.kind == 'replay' and t >= self.start - RECORD:
+                self.recorded.append(list(registers))
+            return registers
+        if self.kind == 'bias':
+            return [min(registers[0] + BIAS, 0xFFFF), registers[1]]
+        if self.kind == 'ramp':
+            return [min(registers[0] + int(RAMP * (t - self.start)), 0xFFFF), registers[1]]
+        if self.kind == 'freeze':
+            if self.frozen is None:
+                self.frozen = list(registers)
+            return self.frozen
+        if self.kind == 'replay' and self.recorded:
+            self.recorded.append(self.recorded.pop(0))
+            return self.recorded[-1]
+        return registers
+
+
+class Link:
+    """Client to tank, through the MITM proxy or a register attack."""
+    def __init__(self, server, proxy, attack, clock):
+        self.server = server
+        self.proxy = proxy
+        self.attack = attack
+        self.clock = clock
+        self.session = proxy.start_session()
+        self.transaction = 0
+
+    def exchange(self, fc, address, value):
+        self.transaction = (self.transaction + 1) & 0xFFFF
+        frame = MBAP_REQUEST.pack(self.transaction, 0, 6, 1, fc, address, value)
+        if isinstance(self.attack, RegisterAttack):
+            request = self.proxy.parse_data(frame)
+            response = self.proxy.parse_response(self.server.handle(frame))
+            offset = self.proxy.window_offset(request, TANK_REG_ADDRESS, 2)
+            if offset is not None:
+                registers = response['register_data']
+                registers[offset:offset + 2] = self.attack.spoof(registers[offset:offset + 2], self.clock.now())
+                return self.proxy.parse_response(self.proxy.create_new_response(response))
+            return response
+        forwarded, request = self.proxy.handle_request(frame, self.session)
+        return self.proxy.parse_response(self.proxy.handle_response(self.server.handle(forwarded), request, self.session))
+
+    def sample(self):
+        """Registers, coil and pump input, read in the order of the sequential acquisition."""
+        registers = self.exchange(3, TANK_REG_ADDRESS, 2)['register_data']
+        coil = self.exchange(1, TANK_COIL_ADDRESS, 1)['coils'][0]
+        hcl_input = self.exchange(2, TANK_INPUT_ADDRESS, 1)['coils'][0]
+        return coil, hcl_input, registers
+
+    def write_coil(self, value):
+        self.exchange(5, TANK_COIL_ADDRESS, 0xFF00 if value else 0x0000)
+
+
+def make_detectors(config, delta):
+    statefulDetector = StatefulDetector(threshold = config.statefulThreshold)
+    statefulDetector.set_delta(delta)
+    return {'stateless': StatelessDetector(threshold = config.statelessThreshold),
+            'stateful': statefulDetector,
+            'ewma': EwmaDetector(),
+            'cusum2': TwoSidedCusumDetector(),
+            'page-hinkley': PageHinkleyDetector(),
+            'chi2': ChiSquareDetector()}
+
+
+def run_trial(scenario, seed, config, delta, duration, warmup, noise):
+    """One seeded run; returns the per-sample times, H residuals, errors and alarms of every detector."""
+    rng = random.Random(seed)
+    inputRate, dilutionRate, update = config.inputRate, config.dilutionRate, config.update
+    period = update * 10
+    start = rng.uniform(warmup, 2 * warmup) if scenario != 'none' else float('inf')
+
+    tank = TankStateClass()
+    tank.set_client_cmd_coil(1)
+    tank.set_h_concentration(rng.randint(9000, 11000))
+    tank.set_hcl_concentration(0)
+
+    clock = ManualClock()
+    proxy = MITMModbusProxy(None, None, None, None)
+    mitm_async.inputRate, mitm_async.dilutionRate, mitm_async.update = inputRate, dilutionRate, update
+    mitm_async.trigger = 0
+    mitm_async.clock = clock
+    attack = RegisterAttack(scenario, start) if scenario in ('bias', 'ramp', 'freeze', 'replay') else None
+    link = Link(TankServer(tank, proxy, noise, rng), proxy, attack, clock)
+
+    pipeline = DetectorPipeline()
+    for name, detector in make_detectors(config, delta).items():
+        pipeline.add(name, detector, H_CONCENTRATION)
+    column = {name: i for i, name in enumerate(DETECTORS)}
+
+    n = int(duration / period)
+    times = np.empty(n)
+    residual = np.zeros(n, dtype=np.int64)
+    error = np.zeros(n, dtype=np.int64)
+    alarms = np.zeros((n, len(DETECTORS)), dtype=bool)
+
+    tankState = kalman = None
+    for i in range(n):
+        # the tank updates, then the client polls
+        clock.advance(period)
+        tank.update_state(inputRate, dilutionRate, update)
+        if scenario == 'mitm' and clock.now() >= start:
+            mitm_async.trigger = 1
+        times[i] = clock.now()
+
+        coil, hcl_input, registers = link.sample()
+        if tankState is None:
+            tankState = TankStateClass()
+            tankState.set_client_cmd_coil(coil)
+            tankState.set_hcl_input(hcl_input)
+            tankState.set_h_concentration(registers[0])
+            tankState.set_hcl_concentration(registers[1])
+            if config.predictor == 'kalman':
+                kalman = KalmanPredictor(inputRate, dilutionRate, update, registers, coil,
+                                         config.processNoise, config.measurementNoise, config.innovationGate,
+                                         config.kalmanResetAfter)
+            continue
+
+        tankState.set_client_cmd_coil(coil)
+        tankState.update_state(inputRate, dilutionRate, update)
+        predicted_reg = tankState.get_concentrations()
+        if kalman is not None:
+            predicted_reg = kalman.predict(coil)
+        for alarm in pipeline.process(registers, predicted_reg, times[i]):
+            alarms[i, column[alarm.name]] = True
+        if kalman is not None:
+            kalman.correct(registers)
+        residual[i] = abs(registers[0] - predicted_reg[0])
+        error[i] = abs(tank.registers[H_CONCENTRATION] - registers[0])
+
+        if registers[0] > hConcentrationThresholdHigh:
+            link.write_coil(False)
+        elif registers[0] < hConcentrationThresholdLow:
+            link.write_coil(True)
+
+    return start, times, residual, error, alarms
+
+
+def score(start, times, residual, error, alarms):
+    """Per detector: detection time after start (None if missed), deviation, error, false alarm onsets, pre-attack hours."""
+    first = np.searchsorted(times, start)
+    onsets = alarms & ~np.vstack((np.zeros((1, alarms.shape[1]), dtype=bool), alarms[:-1]))
+    period = times[1] - times[0] if len(times) > 1 else 0.0
+    hours = first * period / 3600.0
+    scores = []
+    for j in range(alarms.shape[1]):
+        hits = np.flatnonzero(alarms[first:, j])
+        end = first + hits[0] + 1 if len(hits) else len(times)
+        scores.append({'ttd': float(times[first + hits[0]] - start) if len(hits) else None,
+                       'deviation': int(residual[first:end].sum()),
+                       'error': int(error[first:end].max()) if end > first else 0,
+                       'falseAlarms': int(onsets[:first, j].sum()),
+                       'hours': hours})
+    return scores
+
+
+def summarize(trials):
+    """Aggregate the scores of one scenario's trials, per detector."""
+    summary = {}
+    for j, name in enumerate(DETECTORS):
+        scores = [trial[j] for trial in trials]
+        ttds = [s['ttd'] for s in scores if s['ttd'] is not None]
+        hours = sum(s['hours'] for s in scores)
+        summary[name] = {'detected': len(ttds), 'trials': len(scores),
+                         'ttdMedian': float(np.median(ttds)) if ttds else None,
+                         'ttdMax': max(ttds) if ttds else None,
+                         'deviationMax': max(s['deviation'] for s in scores),
+                         'errorMax': max(s['error'] for s in scores),
+                         'falseAlarmsPerHour': sum(s['falseAlarms'] for s in scores) / hours if hours else 0.0}
+    return summary
+
+
+def regressions(results, baseline, tolerance):
+    """Lines for every scenario/detector that got worse than the baseline."""
+    lines = []
+    for scenario, detectors in results['scenarios'].items():
+        for name, now in detectors.items():
+            before = baseline.get('scenarios', {}).get(scenario, {}).get(name)
+            if before is None:
+                continue
+            worse = [key for key in ('detected',) if now[key] < before[key]]
+            worse += [key for key in ('deviationMax', 'errorMax', 'falseAlarmsPerHour') if now[key] > before[key]]
+            if now['ttdMax'] is not None and before['ttdMax'] is not None and now['ttdMax'] > before['ttdMax']:
+                worse.append('ttdMax')
+            if worse:
+                lines.append("{} {}: {}".format(scenario, name, ", ".join(
+                    "{} {} -> {}".format(key, before[key], now[key]) for key in worse)))
+    if results['samplesPerSecond'] < (1.0 - tolerance) * baseline.get('samplesPerSecond', 0.0):
+        lines.append("throughput: {:.0f} -> {:.0f} samples/s".format(baseline['samplesPerSecond'], results['samplesPerSecond']))
+    return lines
+
+
+def format_value(value, spec="{:.1f}"):
+    return "-" if value is None else spec.format(value)
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description="Benchmark detection latency and false alarms in-process.")
+    parser.add_argument("--config", default="dt.json", help="rates, thresholds, delta and predictor")
+    parser.add_argument("--scenarios", nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--trials", type=int, default=5, help="seeded trials per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=3600.0, help="simulated seconds per trial")
+    parser.add_argument("--warmup", type=float, default=600.0, help="the attack starts between warmup and 2 * warmup seconds")
+    parser.add_argument("--noise", type=float, default=0.0, help="standard deviation of the sensor noise on both registers")
+    parser.add_argument("--delta", type=int, default=None, help="stateful detector delta, default: the config's")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="compare with the JSON results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative throughput drop against the baseline")
+    args = parser.parse_args(cmdline)
+    assert args.trials > 0, "trials should be positive"
+    assert 0.0 < 2 * args.warmup < args.duration, "the attack should start well within the duration"
+
+    config = ConfigWatcher(args.config).get()
+    delta = args.delta if args.delta is not None else config.get('delta', 0)
+    mitm_async.hotPath.production = True
+
+    results = {'seed': args.seed, 'trials': args.trials, 'duration': args.duration, 'noise': args.noise,
+               'delta': delta, 'scenarios': {}}
+    samples = 0
+    elapsed = 0.0
+    for scenario in args.scenarios:
+        # seeded by the scenario itself, so running a subset gives the same trials
+        s = SCENARIOS.index(scenario)
+        trials = []
+        for trial in range(args.trials):
+            seed = args.seed * 1000003 + s * 1009 + trial
+            started = time.perf_counter()
+            # the MITM prints its warnings for every spoofed write
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                outcome = run_trial(scenario, seed, config, delta, args.duration, args.warmup, args.noise)
+            elapsed += time.perf_counter() - started
+            samples += len(outcome[1])
+            trials.append(score(*outcome))
+        results['scenarios'][scenario] = summarize(trials)
+    results['samplesPerSecond'] = samples / elapsed if elapsed else 0.0
+
+    print("{:8} {:13} {:>9} {:>9} {:>9} {:>10} {:>8} {:>8}".format(
+        "scenario", "detector", "detected", "ttd p50", "ttd max", "deviation", "error", "fa/h"))
+    for scenario, detectors in results['scenarios'].items():
+        for name, summary in detectors.items():
+            print("{:8} {:13} {:>9} {:>9} {:>9} {:>10} {:>8} {:>8}".format(
+                scenario, name, "{}/{}".format(summary['detected'], summary['trials']),
+                format_value(summary['ttdMedian']), format_value(summary['ttdMax']),
+                summary['deviationMax'], summary['errorMax'], format_value(summary['falseAlarmsPerHour'], "{:.2f}")))
+    print("{} samples, {:.0f} samples/s".format(samples, results['samplesPerSecond']))
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        lines = regressions(results, baseline, args.tolerance)
+        print("\n".join(["Regressions against {}:".format(args.baseline)] + lines) if lines else "No regressions")
+        if lines:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Pick detector thresholds and delta from benign traces.
+
+Given residual traces recorded without an attack ("residuals": 1 and
+"trigger": 0) and a target false-alarm rate, the thresholds come from
+quantiles of the detector statistics:
+
+    stateless   the (1 - p) quantile of |r|
+    stateful    for every delta at once, the (1 - p) quantile of
+                S = max(0, S + |r| - delta) over the benign samples
+
+where p is the target rate per sample (alarms per hour * sample period /
+3600), so at most a fraction p of benign samples would alarm. With attack
+traces as well, the delta whose calibrated threshold lets the least
+deviation through before the first alarm is recommended; without them the
+smallest delta is, since it reacts fastest at the same false-alarm rate.
+
+usage::
+
+    calibrate.py benign1.csv [benign2.csv ...] --far 1 [--attack attack.csv ...]
+                 [--deltas 0 100 1000] [--margin 0] [--update dt.json]
+
+--update writes the recommendation into a config as "statelessThreshold",
+"statefulThreshold" and "delta", which the client reads.
+"""
+import argparse
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from detector import lindley
+from replay import load_trace, residuals, REGISTERS
+from sweep import sweep, DATA_SH_DELTAS
+
+
+Calibration = namedtuple('Calibration', ['stateless_threshold', 'deltas', 'stateful_thresholds', 'per_sample_rate'])
+
+
+def per_sample_rate(far_per_hour, traces):
+    """Alarms per hour as a probability per sample, from the traces' median sample period."""
+    periods = [np.median(np.diff(np.asarray(trace['time'], dtype=np.float64))) for trace in traces if len(trace['time']) > 1]
+    period = float(np.median(periods)) if periods else 1.0
+    return min(1.0, far_per_hour * period / 3600.0)
+
+
+def calibrate(benign, deltas, rate, register='H'):
+    """Thresholds that let at most a fraction `rate` of the benign samples alarm."""
+    deltas = np.asarray(deltas, dtype=np.int64)
+    magnitudes = [residuals(trace, register) for trace in benign]
+    # every trace starts the detector from zero, like a fresh client
+    statistics = np.concatenate([lindley(r[:, None] - deltas[None, :], 0) for r in magnitudes])
+    quantile = 1.0 - rate
+    stateless = np.quantile(np.concatenate(magnitudes), quantile, method='higher')
+    stateful = np.quantile(statistics, quantile, axis=0, method='higher')
+    return Calibration(stateless.item(), deltas, stateful, rate)
+
+
+def evaluate(calibration, attacks, register='H'):
+    """Mean deviation before the first alarm and the number of attack traces detected, per delta."""
+    deviation = np.zeros(len(calibration.deltas))
+    detected = np.zeros(len(calibration.deltas), dtype=np.int64)
+    for trace in attacks:
+        result = sweep(residuals(trace, register), calibration.deltas, calibration.stateful_thresholds, trace['time'])
+        # each delta with its own calibrated threshold: the diagonal of the grid
+        index = np.arange(len(calibration.deltas))
+        deviation += result.deviation[index, index]
+        detected += result.first_alarm[index, index] < len(trace['time'])
+    return deviation / max(len(attacks), 1), detected
+
+
+def recommend(calibration, deviation=None, detected=None):
+    if deviation is None:
+        best = int(np.argmin(calibration.deltas))
+    else:
+        # detect every attack first, then let through the least deviation
+        best = min(range(len(calibration.deltas)), key=lambda i: (-detected[i], deviation[i], calibration.deltas[i]))
+    return {'statelessThreshold': calibration.stateless_threshold,
+            'statefulThreshold': calibration.stateful_thresholds[best].item(),
+            'delta': calibration.deltas[best].item()}
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description="Calibrate detector thresholds and delta from benign traces.")
+    parser.add_argument("benign", nargs='+', type=str, help="residual traces recorded without an attack")
+    parser.add_argument("--far", type=float, default=1.0, help="target false alarms per hour")
+    parser.add_argument("--attack", nargs='*', default=[], help="residual traces recorded under attack")
+    parser.add_argument("--deltas", nargs='+', type=int, default=list(DATA_SH_DELTAS))
+    parser.add_argument("--register", choices=REGISTERS, default='H')
+    parser.add_argument("--margin", type=int, default=0, help="added to every threshold, headroom for noise the traces missed")
+    parser.add_argument("--update", type=str, default=None, help="config file to write the recommendation into")
+    args = parser.parse_args(cmdline)
+    assert args.far >= 0.0, "far should be non-negative"
+
+    benign = [load_trace(path) for path in args.benign]
+    rate = per_sample_rate(args.far, benign)
+    calibration = calibrate(benign, args.deltas, rate, args.register)
+    calibration = calibration._replace(stateless_threshold=calibration.stateless_threshold + args.margin,
+                                       stateful_thresholds=calibration.stateful_thresholds + args.margin)
+    print("{} benign samples, {:.3g} false alarms per sample allowed".format(sum(len(t['time']) for t in benign), rate))
+    print("Stateless threshold: {}".format(calibration.stateless_threshold))
+
+    deviation = detected = None
+    if args.attack:
+        attacks = [load_trace(path) for path in args.attack]
+        deviation, detected = evaluate(calibration, attacks, args.register)
+    for i, delta in enumerate(calibration.deltas):
+        line = "Delta: {}, Threshold: {}".format(delta, calibration.stateful_thresholds[i])
+        if deviation is not None:
+            line += ", Deviation: {:.1f}, Detected: {}/{}".format(deviation[i], detected[i], len(args.attack))
+        print(line)
+
+    recommendation = recommend(calibration, deviation, detected)
+    print("Recommended: {}".format(json.dumps(recommendation)))
+    if args.update is not None:
+        with open(args.update, "r") as file:
+            config = json.load(file)
+        config.update(recommendation)
+        with open(args.update, "w") as file:
+            json.dump(config, file, indent=4)
+            file.write("\n")
+        print("written to {}".format(args.update))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ usage::
 The corresponding server must be started before e.g. as:
     python3 server_sync.py
 """
+import argparse
 import asyncio
 import logging
 import sys
@@ -33,10 +34,19 @@ import pdb
 import os
 import json
 import time
-import csv
 import math
 from tank_state import *
 from detector import *
+from sim_clock import RealClock, get_clock
+from dt_config import ConfigWatcher
+from scheduler import DeadlineScheduler
+from acquisition import TankSampler
+from adaptive_poll import AdaptivePollPolicy
+from kalman import KalmanPredictor
+from client_metrics import ClientMetrics
+from telemetry import TelemetryWriter, open_sink, RESIDUAL_HEADER
+from ts_store import RESIDUAL_COLUMNS
+from log_setup import setup_logging, set_log_mode, HotPath
 
 try:
     import helper
@@ -52,17 +62,22 @@ from pymodbus import ModbusException
 
 global dtDict
 global argFile, inputRate, dilutionRate, update
+global configWatcher
 global delta
+global clock
+global telemetry, residualTrace
+global clientMetrics
+clientMetrics = ClientMetrics()
+clock = RealClock()
 
 _logger = logging.getLogger(__file__)
-logging.basicConfig(filename='logs/async_client.log', level=logging.DEBUG)
-_logger.setLevel("DEBUG")
+hotPath = HotPath(_logger)
 
 
 
 
 def setup_async_client(description=None, cmdline=None):
-    global dtDict, argFile, delta
+    global dtDict, argFile, delta, configWatcher
     """Run client setup."""
     args = helper.get_commandline(
         server=False, description=description, cmdline=cmdline
@@ -71,8 +86,8 @@ def setup_async_client(description=None, cmdline=None):
     if args.file != None:
         argFile = os.path.join('.', args.file)
         try:
-            with open(argFile,'r') as rf:
-                dtDict = json.load(rf)
+            configWatcher = ConfigWatcher(argFile)
+            dtDict = configWatcher.get()
         except:
             print("error opening argument file {}\n".format(argFile))
             exit(1)
@@ -80,7 +95,8 @@ def setup_async_client(description=None, cmdline=None):
     _logger.info("### Create client object")
     client = None
 
-    delta = args.delta
+    # an explicit --delta wins over the config's (see calibrate.py)
+    delta = args.delta if args.delta is not None else dtDict.get('delta', 0)
 
     if args.comm == "tcp":
         client = modbusClient.AsyncModbusTcpClient(
@@ -153,31 +169,19 @@ async def run_async_client(client, modbus_calls=None):
 def update_inputs():
     global dtDict, argFile, inputRate, dilutionRate, update
 
-    with open(argFile,'r') as rf:
-        dtDict = json.load(rf)
+    # already validated, and only re-read when the file changed
+    dtDict = configWatcher.get()
 
-
-    if 'inputRate' in dtDict:
-        inputRate = dtDict['inputRate'] # Rate of HCl entering tank
-
-    assert inputRate > 0.0, "inputRate should be positive"
-
-    if 'dilutionRate' in dtDict:
-        dilutionRate = dtDict['dilutionRate'] # Rate of water entering tank
-
-    assert dilutionRate > 0.0, "dilutionRate should be positive"
-
-    if 'update' in dtDict:
-        update = dtDict['update']
-
-    assert 0.0 < update < 10.0, "update should be positive and less than 10 seconds"
+    inputRate = dtDict.inputRate # Rate of HCl entering tank
+    dilutionRate = dtDict.dilutionRate # Rate of water entering tank
+    update = dtDict.update
 
 
 async def run_a_few_calls(client):
-    global dtDict, argFile, inputRate, dilutionRate, update, delta
+    global dtDict, argFile, inputRate, dilutionRate, update, delta, clock, telemetry, residualTrace
 
-    statelessDetector = StatelessDetector(threshold = 2000)
-    statefulDetector = StatefulDetector(threshold = 2000)
+    statelessDetector = StatelessDetector(threshold = dtDict.statelessThreshold)
+    statefulDetector = StatefulDetector(threshold = dtDict.statefulThreshold)
 
     statefulDetector.set_delta(delta)
 
@@ -196,89 +200,115 @@ async def run_a_few_calls(client):
         curCoilState = True
 
 
-        rr = await client.read_coils(0, 1, slave=1)
-        output_coils = rr.bits
-        print(output_coils[0])
-
-        rr = await client.read_discrete_inputs(2, 1, slave=1)
-        discrete_inputs = rr.bits
-        print(discrete_inputs[0])
-
-        rr = await client.read_holding_registers(4, 2, slave=1)
-        registers = rr.registers
+        update_inputs()
+        hotPath.production = set_log_mode(dtDict.logMode)
+
+        # residuals of H and HCl are computed once per sample for all detectors
+        pipeline = DetectorPipeline()
+        pipeline.add("Stateless", statelessDetector, H_CONCENTRATION, [print_alarm])
+        stateful_handlers = [print_alarm, RecordAlarm("data.txt")]
+        if dtDict.onAlarm == 'exit':
+            stateful_handlers.append(exit_on_alarm)
+        pipeline.add("Stateful", statefulDetector, H_CONCENTRATION, stateful_handlers)
+        pipeline.add("Stateless HCl", StatelessDetector(threshold = dtDict.statelessThreshold), HCL_CONCENTRATION, [log_alarm])
+        # latency per function code, printed at exit and on SIGUSR1
+        clientMetrics.attach(client)
+        clientMetrics.report_at_exit()
+        clock = get_clock(dtDict, 'client')
+        telemetry = TelemetryWriter(open_sink("data/ph_data", dtDict.telemetry))
+        # measured and predicted concentrations of every poll, for replay.py
+        residualTrace = None
+        if dtDict.residuals == 1:
+            residualTrace = TelemetryWriter(open_sink("data/residuals", dtDict.telemetry, RESIDUAL_HEADER, RESIDUAL_COLUMNS))
+        scheduler = DeadlineScheduler(update * 10, clock, policy=dtDict.catchUp)
+        sampler = TankSampler(client, dtDict.get('registerMap'), mode=dtDict.acquisition, clock=clock)
+        # with adaptive polling, polls the control loop would not act on are skipped
+        poller = None
+        if dtDict.polling == 'adaptive':
+            poller = AdaptivePollPolicy(inputRate, dilutionRate, update, hConcentrationThresholdLow, hConcentrationThresholdHigh,
+                                        minPeriods=dtDict.minPollPeriods, maxPeriods=dtDict.maxPollPeriods)
+        periods = 1
+
+        sample = await sampler.sample()
+        registers = sample.registers
         prev_registers = registers
+        print(sample.coil)
+        print(sample.hcl_input)
         print("Registers {}".format(registers))
 
         tankState = TankStateClass()
-        tankState.set_client_cmd_coil(output_coils[0])
-        tankState.set_hcl_input(discrete_inputs[0])
+        tankState.set_client_cmd_coil(sample.coil)
+        tankState.set_hcl_input(sample.hcl_input)
         tankState.set_h_concentration(registers[0])
         tankState.set_hcl_concentration(registers[1])
 
         print(tankState.get_tank_state())
-        update_inputs()
+
+        # "predictor": "kalman" corrects the prediction with every accepted measurement
+        kalman = None
+        if dtDict.predictor == 'kalman':
+            kalman = KalmanPredictor(inputRate, dilutionRate, update, registers, sample.coil,
+                                     dtDict.processNoise, dtDict.measurementNoise, dtDict.innovationGate,
+                                     dtDict.kalmanResetAfter)
 
         while True:
-            await asyncio.sleep(update * 10)
+            lateness = await scheduler.wait(periods)
+            _logger.debug("poll %d started %.6fs late", scheduler.ticks, lateness)
 
-            rr = await client.read_holding_registers(4, 2, slave=1)
-            registers = rr.registers
+            # coil, pump input and registers of one poll, with their timestamp
+            sample = await sampler.sample()
+            registers = sample.registers
             # if registers == prev_registers:
             #     continue
 
-            rr = await client.read_coils(0, 1, slave=1)
-            output_coil = rr.bits[0]
-            # print(output_coils[0])
-
-            tankState.set_client_cmd_coil(output_coil)
+            tankState.set_client_cmd_coil(sample.coil)
             # curCoilState = output_coil
 
-            rr = await client.read_discrete_inputs(2, 1, slave=1)
-            discrete_inputs = rr.bits
-            # print(discrete_inputs[0])
 
-
-            print("Tank State      {}".format(registers))
+            hotPath("Tank State      %s", registers)
 
             
-            current_time = time.time()
+            current_time = sample.timestamp
             conc = (registers[0] / (10**11))
             pH_value = -math.log10(conc)
 
-            tankState.update_state(inputRate, dilutionRate, update)
+            if periods == 1:
+                tankState.update_state(inputRate, dilutionRate, update)
+            else:
+                # the coil was not written since the last poll, so it held for every skipped update
+                tankState.advance_state(periods, inputRate, dilutionRate, update)
             predicted_reg = tankState.get_concentrations()
-            print("Predicted State {}".format(predicted_reg))
-            print("")
-
-            #Stateless detection
-            if statelessDetector.detect(registers[0], predicted_reg[0]):
-                print("ALERT: Stateless detector")
+            if kalman is not None:
+                predicted_reg = kalman.predict(sample.coil, periods)
+            hotPath("Predicted State %s\n", predicted_reg)
+            if residualTrace is not None:
+                residualTrace.write([current_time, registers[0], predicted_reg[0], registers[1], predicted_reg[1]])
 
-            #Stateful detection
-            if statefulDetector.detect(registers[0], predicted_reg[0]):
-                print("ALERT: Stateful detector: {}".format(statefulDetector.get_deviation()))
-                with open("data.txt", "a") as file:
-                    file.write("Delta: {}, Deviation: {}\n".format(statefulDetector.get_delta(), statefulDetector.get_deviation()))
-                sys.exit()
+            # Stateless and stateful detection; the stateful alarm records the deviation and, by default, exits
+            pipeline.process(registers, predicted_reg, current_time)
+            if kalman is not None:
+                kalman.correct(registers)
 
 
             # Get current state of the system from the coils and registers
 
+            curCoilState = sample.coil
             if registers[0] > hConcentrationThresholdHigh:
-                # curCoilState = False
-                await client.write_coil(0, False, slave=1)
-                print("Turning coil off")
+                curCoilState = False
+                await sampler.write_coil(False)
+                hotPath("Turning coil off")
                 # tankState.set_client_cmd_coil(curCoilState)
             elif registers[0] < hConcentrationThresholdLow:
-                # curCoilState = True
-                await client.write_coil(0, True, slave=1)
-                print("Turning coil on")
+                curCoilState = True
+                await sampler.write_coil(True)
+                hotPath("Turning coil on")
                 # tankState.set_client_cmd_coil(curCoilState)
+
+            if poller is not None:
+                periods = poller.next_periods(registers, curCoilState, registers[0] - predicted_reg[0])
             
-            pump_state = tankState.get_tank_state()['inputs'][0]
-            with open("data/ph_data.csv", mode='a', newline='') as f:
-                ph_writer = csv.writer(f)
-                ph_writer.writerow([current_time, pH_value,pump_state])
+            pump_state = tankState.inputs[HCL]
+            telemetry.write([current_time, pH_value, pump_state])
             prev_registers = registers
 
     except ModbusException:
@@ -292,8 +322,19 @@ async def main(cmdline=None):
 
 
 
+def config_log_mode(cmdline=None):
+    """logMode of the --file config, needed before the event loop starts."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--file", default=None)
+    args, _ = parser.parse_known_args(cmdline)
+    if args.file is None:
+        return 'debug'
+    try:
+        return ConfigWatcher(os.path.join('.', args.file)).get().logMode
+    except Exception:
+        return 'debug'      # setup_async_client reports the bad file
+
+
 if __name__ == "__main__":
-    with open("data/ph_data.csv", mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Time (s)", "actual_pH", "HCl_pump_state"]) #csv header
-    asyncio.run(main(), debug=True)
+    setup_logging('logs/async_client.log')
+    asyncio.run(main(), debug=config_log_mode() != 'production')
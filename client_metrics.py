@@ -0,0 +1,159 @@
+"""Round-trip latency of the client's Modbus requests.
+
+ClientMetrics.attach(client) wraps the client's execute() and send(), which
+every read_*/write_* call goes through, and records per function code:
+
+    latency     HDR-style histogram of the round trip, request to response,
+                including pymodbus' own retries
+    errors      Modbus exception responses
+    timeouts    requests that got no response after all retries
+    retries     packets sent again after a response timed out
+
+A MITM or an extra network hop shows up as a shift of these latencies.
+The summary (count, p50, p99, max per function code) is printed at exit and
+whenever the process gets SIGUSR1.
+
+usage::
+
+    clientMetrics = ClientMetrics()
+    clientMetrics.attach(client)
+    clientMetrics.report_at_exit()
+"""
+import atexit
+import math
+import signal
+import sys
+import time
+
+from pymodbus.exceptions import ModbusIOException
+
+
+class HdrHistogram:
+    """Log-linear histogram of integer microseconds with bounded relative error.
+
+    Values below 2 * sub_buckets are counted exactly; above, every power of
+    two range is split into sub_buckets equal buckets, so a recorded value is
+    off by at most 1 / sub_buckets, whatever its magnitude.
+    """
+    def __init__(self, significant_digits=2, highest=60 * 10**6):
+        assert 1 <= significant_digits <= 5, "significant_digits should be in [1, 5]"
+        self.sub_bits = math.ceil(math.log2(2 * 10**significant_digits))
+        self.exact = 1 << self.sub_bits             # values below this are their own bucket
+        self.half = self.exact >> 1
+        self.highest = highest
+        self.counts = [0] * (self.index(highest) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        if value < self.exact:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return self.exact + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def value_at(self, index):
+        """Lowest value counted in bucket index."""
+        if index < self.exact:
+            return index
+        shift = (index - self.exact) // self.half + 1
+        return (self.half + (index - self.exact) % self.half) << shift
+
+    def record(self, value):
+        value = min(max(int(value), 0), self.highest)
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class RequestStats:
+    def __init__(self, name):
+        self.name = name
+        self.latency = HdrHistogram()       # microseconds
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+
+
+class ClientMetrics:
+    def __init__(self):
+        self.stats = {}         # function code -> RequestStats
+        self.sends = 0
+
+    def attach(self, client):
+        execute = client.execute
+        send = client.send
+
+        def counting_send(*args, **kwargs):
+            self.sends += 1
+            return send(*args, **kwargs)
+
+        async def timed(request, stats, response):
+            sendsBefore = self.sends
+            start = time.perf_counter()
+            try:
+                result = await response
+            except ModbusIOException:
+                stats.timeouts += 1
+                raise
+            finally:
+                # with concurrent requests on one client these may include a neighbour's retries
+                stats.retries += max(self.sends - sendsBefore - 1, 0)
+            stats.latency.record((time.perf_counter() - start) * 10**6)
+            if result is not None and result.isError():
+                stats.errors += 1
+            return result
+
+        def timed_execute(request=None):
+            response = execute(request)
+            if not hasattr(response, '__await__'):
+                return response         # a sync client, nothing to time
+            fc = request.function_code
+            if fc not in self.stats:
+                self.stats[fc] = RequestStats(type(request).__name__.replace("Request", ""))
+            return timed(request, self.stats[fc], response)
+
+        client.send = counting_send
+        client.execute = timed_execute
+        return client
+
+    def summary(self):
+        lines = []
+        for fc, stats in sorted(self.stats.items()):
+            h = stats.latency
+            if h.count:
+                lines.append("fc {} {}: n={} p50={:.3f}ms p99={:.3f}ms max={:.3f}ms errors={} timeouts={} retries={}".format(
+                    fc, stats.name, h.count, h.percentile(50) / 1000.0, h.percentile(99) / 1000.0, h.max / 1000.0,
+                    stats.errors, stats.timeouts, stats.retries))
+            else:
+                lines.append("fc {} {}: n=0 errors={} timeouts={} retries={}".format(
+                    fc, stats.name, stats.errors, stats.timeouts, stats.retries))
+        return lines
+
+    def report(self, out=None):
+        out = sys.stdout if out is None else out
+        out.write("".join(line + "\n" for line in ["Modbus request latency:"] + self.summary()))
+        out.flush()
+
+    def report_at_exit(self, sig=signal.SIGUSR1):
+        """Print the summary at exit, and on sig (None: only at exit)."""
+        atexit.register(self.report)
+        if sig is not None:
+            signal.signal(sig, lambda signum, frame: self.report())
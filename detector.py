@@ -1,3 +1,30 @@
+import abc
+import logging
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+
+_logger = logging.getLogger(__file__)
+
+
+def lindley(increments, initial=0):
+    """S_n = max(0, S_(n-1) + increments_n) for every n along axis 0, in closed form.
+
+    With C_n = cumsum(increments), S_n = C_n - min(-S_0, min_(k<=n) C_k).
+    """
+    cumulative = np.cumsum(increments, axis=0)
+    return cumulative - np.minimum(np.minimum.accumulate(cumulative, axis=0), -np.asarray(initial))
+
+
+def as_residuals(actual, predicted):
+    actual = np.asarray(actual)
+    predicted = np.asarray(predicted)
+    if actual.dtype.kind in 'iub' and predicted.dtype.kind in 'iub':
+        # integer registers: keep the sums exact
+        return actual.astype(np.int64) - predicted.astype(np.int64)
+    return actual.astype(np.float64) - predicted.astype(np.float64)
 
 
 class StatelessDetector:
@@ -8,11 +35,18 @@ class StatelessDetector:
         self.threshold = thredhold
     
     def detect(self, actual, predicted):
-        if abs(actual - predicted) > self.threshold:
+        return self.detect_residual(actual - predicted)
+
+    def detect_residual(self, residual):
+        if abs(residual) > self.threshold:
             return True
         else:
             return False
-        
+
+    def detect_many(self, actual, predicted):
+        return np.abs(as_residuals(actual, predicted)) > self.threshold
+
+
 class StatefulDetector:
     def __init__(self, threshold = 0):
         self.threshold = threshold
@@ -38,7 +72,11 @@ class StatefulDetector:
         return self.deviation
 
     def detect(self, actual, predicted):
-        self.residual += abs(actual - predicted)
+        return self.detect_residual(actual - predicted)
+
+    def detect_residual(self, residual):
+        residual = abs(residual)
+        self.residual += residual
         self.residual -= self.delta
         self.residual = 0 if self.residual < 0 else self.residual
 
@@ -47,5 +85,222 @@ class StatefulDetector:
             self.detected = 1
             return True
         else:
-            self.deviation += 0 if self.detected == 1 else abs(actual - predicted)
-            return False
\ No newline at end of file
+            self.deviation += 0 if self.detected == 1 else residual
+            return False
+
+    def detect_many(self, actual, predicted):
+        """detect() over a whole 1-d sequence of samples, in closed form."""
+        residual = np.abs(as_residuals(actual, predicted))
+        statistic = lindley(residual - self.delta, self.residual)
+        alarms = statistic > self.threshold
+        if len(residual):
+            self.residual = statistic[-1].item()
+        if self.detected == 0:
+            first = np.argmax(alarms) if alarms.any() else len(residual)
+            self.deviation += residual[:first].sum().item()
+            self.detected = 1 if alarms.any() else 0
+        return alarms
+
+
+class StreamingDetector(abc.ABC):
+    """Base of the detectors that keep a fixed amount of state per stream.
+
+    detect(actual, predicted) takes one sample of a single stream.
+    detect_many(actual, predicted) takes arrays of shape (T,) for one stream
+    or (T, streams) and returns the alarms in the same shape; it carries the
+    state over between calls, so feeding a trace in pieces or sample by
+    sample gives the same alarms. Long inputs are processed CHUNK rows at a
+    time, which bounds the temporaries and keeps the cumulative sums exact.
+    """
+    CHUNK = 4096
+
+    def __init__(self, threshold, streams=1):
+        assert streams >= 1, "streams should be positive"
+        self.threshold = threshold
+        self.streams = streams
+        self.samples = 0
+
+    def set_threshold(self, threshold):
+        self.threshold = threshold
+
+    def detect(self, actual, predicted):
+        return self.detect_residual(actual - predicted)
+
+    def detect_residual(self, residual):
+        assert self.streams == 1, "detect() feeds a single stream, use detect_many()"
+        return bool(self._update(np.asarray([[residual]], dtype=np.float64))[0, 0])
+
+    def detect_many(self, actual, predicted):
+        residuals = as_residuals(actual, predicted).astype(np.float64)
+        single = residuals.ndim == 1
+        if single:
+            residuals = residuals[:, None]
+        assert residuals.shape[1] == self.streams, "expected {} streams".format(self.streams)
+        alarms = np.empty(residuals.shape, dtype=bool)
+        for start in range(0, len(residuals), self.CHUNK):
+            alarms[start:start + self.CHUNK] = self._update(residuals[start:start + self.CHUNK])
+        return alarms[:, 0] if single else alarms
+
+    @abc.abstractmethod
+    def _update(self, residuals):
+        """Alarms for a (rows, streams) block of residuals, advancing the state past it."""
+
+    def zeros(self):
+        return np.zeros(self.streams, dtype=np.float64)
+
+
+class EwmaDetector(StreamingDetector):
+    """z_n = (1 - lam) z_(n-1) + lam r_n; alarm when |z_n| > threshold."""
+    def __init__(self, lam=0.2, threshold=1000, streams=1):
+        assert 0.0 < lam <= 1.0, "lam should be in (0, 1]"
+        super().__init__(threshold, streams)
+        self.lam = lam
+        self.z = self.zeros()
+        # within a block z is a^j * cumsum(a^-i * lam * r); a^-i stays below 1e6
+        decay = 1.0 - lam
+        self.block = 1 if decay == 0.0 else max(1, int(6 * np.log(10) / -np.log(decay)))
+
+    def _update(self, residuals):
+        decay = 1.0 - self.lam
+        out = np.empty_like(residuals)
+        for start in range(0, len(residuals), self.block):
+            r = residuals[start:start + self.block]
+            j = np.arange(len(r))[:, None]
+            if decay == 0.0:
+                out[start:start + len(r)] = r
+            else:
+                out[start:start + len(r)] = decay ** (j + 1) * self.z + decay ** j * np.cumsum(self.lam * r * decay ** -j, axis=0)
+            self.z = out[start + len(r) - 1].copy()
+        self.samples += len(residuals)
+        return np.abs(out) > self.threshold
+
+
+class TwoSidedCusumDetector(StreamingDetector):
+    """S+ = max(0, S+ + r - drift), S- = max(0, S- - r - drift); alarm when either exceeds threshold."""
+    def __init__(self, drift=0, threshold=2000, streams=1):
+        super().__init__(threshold, streams)
+        self.drift = drift
+        self.high = self.zeros()
+        self.low = self.zeros()
+
+    def _update(self, residuals):
+        high = lindley(residuals - self.drift, self.high)
+        low = lindley(-residuals - self.drift, self.low)
+        self.high, self.low = high[-1].copy(), low[-1].copy()
+        self.samples += len(residuals)
+        return (high > self.threshold) | (low > self.threshold)
+
+
+class PageHinkleyDetector(StreamingDetector):
+    """Page-Hinkley test for a rise of the mean of |r|.
+
+    m_n = m_(n-1) + |r_n| - mean_n - delta, with mean_n the running mean of
+    |r|; alarm when m_n - min_(k<=n) m_k > threshold.
+    """
+    def __init__(self, delta=0, threshold=2000, streams=1):
+        super().__init__(threshold, streams)
+        self.delta = delta
+        self.total = self.zeros()
+        self.m = self.zeros()
+        self.m_min = self.zeros()
+
+    def _update(self, residuals):
+        x = np.abs(residuals)
+        counts = self.samples + np.arange(1, len(x) + 1, dtype=np.float64)[:, None]
+        mean = (self.total + np.cumsum(x, axis=0)) / counts
+        m = self.m + np.cumsum(x - mean - self.delta, axis=0)
+        m_min = np.minimum(np.minimum.accumulate(m, axis=0), self.m_min)
+        self.total = self.total + x.sum(axis=0)
+        self.m, self.m_min = m[-1].copy(), m_min[-1].copy()
+        self.samples += len(x)
+        return m - m_min > self.threshold
+
+
+class ChiSquareDetector(StreamingDetector):
+    """Sum of (r / sigma)^2 over the last `window` samples; alarm when above threshold.
+
+    Keeps the last window - 1 squared residuals per stream.
+    """
+    def __init__(self, window=10, threshold=2000, sigma=1.0, streams=1):
+        assert window >= 1, "window should be at least 1"
+        assert sigma > 0.0, "sigma should be positive"
+        super().__init__(threshold, streams)
+        self.window = window
+        self.sigma = sigma
+        self.history = np.zeros((window - 1, streams), dtype=np.float64)
+
+    def _update(self, residuals):
+        squares = np.concatenate([self.history, (residuals / self.sigma) ** 2])
+        cumulative = np.concatenate([np.zeros((1, self.streams)), np.cumsum(squares, axis=0)])
+        # before the window has filled, the history is zeros and the sum covers fewer samples
+        statistic = cumulative[self.window:] - cumulative[:-self.window]
+        self.history = squares[len(squares) - (self.window - 1):]
+        self.samples += len(residuals)
+        return statistic > self.threshold
+
+
+Alarm = namedtuple('Alarm', ['name', 'detector', 'register', 'residual', 'timestamp'])
+
+
+class DetectorPipeline:
+    """Residuals of all registers computed once per sample, fanned out to every detector.
+
+    Each detector watches one register and routes its alarms to its own
+    handlers, or to the pipeline's when it has none. A handler is any
+    callable taking an Alarm.
+    """
+    def __init__(self, handlers=None):
+        self.detectors = []     # (name, detector, register, handlers)
+        self.handlers = list(handlers) if handlers else []
+
+    def add(self, name, detector, register=0, handlers=None):
+        self.detectors.append((name, detector, register, handlers))
+        return detector
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def process(self, actual, predicted, timestamp=None):
+        """Feed one sample to every detector; returns the alarms it raised."""
+        residuals = [a - p for a, p in zip(actual, predicted)]
+        alarms = []
+        for name, detector, register, handlers in self.detectors:
+            if detector.detect_residual(residuals[register]):
+                alarms.append((Alarm(name, detector, register, residuals[register], timestamp), handlers))
+        # every detector has seen the sample before any handler runs (one may exit)
+        for alarm, handlers in alarms:
+            for handler in (handlers if handlers is not None else self.handlers):
+                handler(alarm)
+        return [alarm for alarm, _ in alarms]
+
+
+def print_alarm(alarm):
+    if isinstance(alarm.detector, StatefulDetector):
+        print("ALERT: {} detector: {}".format(alarm.name, alarm.detector.get_deviation()))
+    else:
+        print("ALERT: {} detector".format(alarm.name))
+
+
+def log_alarm(alarm):
+    _logger.warning("%s detector alarm on register %d, residual %d", alarm.name, alarm.register, alarm.residual)
+
+
+class RecordAlarm:
+    """Append the stateful detector's delta and deviation to a results file, like data.txt.
+
+    Only a detector's first alarm is recorded, its deviation stops growing there.
+    """
+    def __init__(self, path="data.txt"):
+        self.path = path
+        self.recorded = set()
+
+    def __call__(self, alarm):
+        if id(alarm.detector) in self.recorded:
+            return
+        self.recorded.add(id(alarm.detector))
+        with open(self.path, "a") as file:
+            file.write("Delta: {}, Deviation: {}\n".format(alarm.detector.get_delta(), alarm.detector.get_deviation()))
+
+
+def exit_on_alarm(alarm):
+    sys.exit()
\ No newline at end of file
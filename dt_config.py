@@ -0,0 +1,160 @@
+"""Cached, validated digital-twin configuration (dt.json).
+
+ConfigWatcher keeps the parsed config of one file and only re-reads it when
+the file's mtime or size changes. get() returns an immutable DTConfig, so
+callers can check `config is not lastConfig` to see whether anything changed.
+A file that fails to parse or validate on reload is reported once and the
+previous config is kept until the file changes again; a bad file on the
+first load raises.
+
+usage::
+
+    configWatcher = ConfigWatcher('dt.json')
+    config = configWatcher.get()          # cheap when the file is unchanged
+    inputRate = config.inputRate
+"""
+import json
+import logging
+import os
+import time
+from collections.abc import Mapping
+from types import MappingProxyType
+
+
+_logger = logging.getLogger(__file__)
+
+# values the scripts fell back to when a key is missing from the file
+DEFAULTS = {'HCl': 0, 'pH': 7, 'trigger': 0, 'clock': 'real', 'catchUp': 'skip', 'acquisition': 'sequential',
+            'telemetry': 'csv', 'logMode': 'debug', 'residuals': 0,
+            'polling': 'fixed', 'minPollPeriods': 1, 'maxPollPeriods': 10, 'onAlarm': 'exit',
+            'statelessThreshold': 2000, 'statefulThreshold': 2000,
+            'predictor': 'twin', 'processNoise': 1.0, 'measurementNoise': 1.0, 'innovationGate': 13.8,
+            'kalmanResetAfter': 300}
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def tank_sections(config):
+    """Return one dict per tank: its "tanks" entry merged over the top-level values."""
+    shared = {key: value for key, value in config.items() if key != 'tanks'}
+    sections = []
+    for i, section in enumerate(config['tanks']):
+        merged = dict(shared)
+        merged.update(section)
+        merged.setdefault('slave', i + 1)
+        sections.append(merged)
+    return sections
+
+
+def validate_rates(values):
+    assert values.get('inputRate', 0) > 0.0, "inputRate should be positive"
+    assert values.get('dilutionRate', 0) > 0.0, "dilutionRate should be positive"
+
+
+def validate(values):
+    assert 0.0 < values.get('update', 1.0) < 10.0, "update should be positive and less than 10 seconds"
+    if 'port' in values:
+        assert values['port']==502 or 5000 < values['port'] < 10000, "port should either be 502 or in (5000,10000)"
+    assert 0 <= values['pH'] <= 14, "water pH should be in [0, 14]"
+    assert values['HCl'] == 0 or values['HCl'] == 1, "hcl pump can either be 0 or 1"
+    assert values['catchUp'] in ('skip', 'burst', 'slew'), "catchUp should be 'skip', 'burst' or 'slew'"
+    assert values['acquisition'] in ('sequential', 'concurrent', 'image'), "acquisition should be 'sequential', 'concurrent' or 'image'"
+    assert values['telemetry'] in ('csv', 'columnar'), "telemetry should be 'csv' or 'columnar'"
+    assert values['logMode'] in ('debug', 'production'), "logMode should be 'debug' or 'production'"
+    assert values['residuals'] == 0 or values['residuals'] == 1, "residuals can either be 0 or 1"
+    assert values['polling'] in ('fixed', 'adaptive'), "polling should be 'fixed' or 'adaptive'"
+    assert values['onAlarm'] in ('exit', 'continue'), "onAlarm should be 'exit' or 'continue'"
+    assert 1 <= values['minPollPeriods'] <= values['maxPollPeriods'], "poll periods should satisfy 1 <= minPollPeriods <= maxPollPeriods"
+    assert values['statelessThreshold'] >= 0 and values['statefulThreshold'] >= 0, "detector thresholds should be non-negative"
+    assert values.get('delta', 0) >= 0, "delta should be non-negative"
+    assert values['predictor'] in ('twin', 'kalman'), "predictor should be 'twin' or 'kalman'"
+    assert values['processNoise'] >= 0.0 and values['measurementNoise'] > 0.0, "processNoise should be non-negative and measurementNoise positive"
+    assert values['innovationGate'] > 0.0, "innovationGate should be positive"
+    assert values['kalmanResetAfter'] >= 1, "kalmanResetAfter should be at least 1"
+
+    if 'tanks' in values:
+        sections = tank_sections(values)
+        assert len(sections) > 0, "tanks should list at least one tank"
+        for section in sections:
+            validate_rates(section)
+    else:
+        validate_rates(values)
+
+
+class DTConfig(Mapping):
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        values = dict(DEFAULTS, **values)
+        # the MITM ignores any trigger other than 0 or 1
+        if values['trigger'] != 0 and values['trigger'] != 1:
+            values['trigger'] = 0
+        validate(values)
+        object.__setattr__(self, '_values', freeze(values))
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DTConfig is read-only")
+
+    def __repr__(self):
+        return repr(dict(self._values))
+
+
+class ConfigWatcher:
+    def __init__(self, path, min_interval=0.0):
+        self.path = path
+        self.min_interval = min_interval    # seconds between two stat() calls
+        self.config = None
+        self.signature = None
+        self.last_check = 0.0
+        self.reload(initial=True)
+
+    def reload(self, initial=False):
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return self.config
+        try:
+            with open(self.path, 'r') as rf:
+                config = DTConfig(json.load(rf))
+        except (ValueError, TypeError, KeyError, AssertionError) as e:
+            if initial:
+                raise
+            # keep the last good config, e.g. while an editor is rewriting the file,
+            # and only look at the file again once it changes
+            _logger.warning("ignoring invalid config %s: %s", self.path, e)
+            self.signature = signature
+            return self.config
+        self.config = config
+        self.signature = signature
+        return config
+
+    def get(self):
+        now = time.monotonic()
+        if now - self.last_check >= self.min_interval:
+            self.last_check = now
+            try:
+                self.reload()
+            except OSError as e:
+                _logger.warning("cannot read config %s: %s", self.path, e)
+        return self.config
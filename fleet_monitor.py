@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Monitor many tanks from one event loop.
+
+Every tank gets its own TankStateClass predictor (or KalmanPredictor with
+"predictor": "kalman"), stateless and stateful detector and pump control, exactly like client_async.py does for one tank.
+Tanks on the same host and port share one pooled, reconnecting Modbus
+connection, and at most --max-inflight samples are in flight at once.
+
+usage::
+
+    fleet_monitor.py --file fleet.json [--max-inflight N] [--delta DELTA]
+
+The tanks are the "tanks" section of the config (as served by waterTank.py
+in fleet mode); each entry may also set "host" and "port". A config without
+"tanks" monitors the single tank of client_async.py. Alarms are reported and
+the tank keeps being monitored, the others are not affected.
+"""
+import asyncio
+import logging
+import math
+import os
+import sys
+
+from tank_state import *
+from detector import *
+from sim_clock import get_clock
+from dt_config import ConfigWatcher, tank_sections
+from scheduler import DeadlineScheduler
+from acquisition import TankSampler
+from kalman import KalmanPredictor
+from log_setup import setup_logging
+
+try:
+    import helper
+except ImportError:
+    print("*** ERROR --> THIS EXAMPLE needs the example directory, please see \n\
+          https://pymodbus.readthedocs.io/en/latest/source/examples.html\n\
+          for more information.")
+    sys.exit(-1)
+
+import pymodbus.client as modbusClient
+from pymodbus import ModbusException
+from pymodbus.exceptions import ConnectionException
+
+
+_logger = logging.getLogger(__file__)
+
+hConcentrationThresholdHigh = 11220.2 # this should be roughly a pH of 6.95
+hConcentrationThresholdLow = 8912.5 # pH of 7.05
+
+
+class ConnectionPool:
+    """One reconnecting Modbus TCP client per (host, port); only clients that connected are kept."""
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.clients = {}
+
+    async def get(self, host, port):
+        key = (host, port)
+        client = self.clients.get(key)
+        if client is None:
+            client = modbusClient.AsyncModbusTcpClient(
+                host,
+                port=port,
+                timeout=self.timeout,
+                retries=3,
+                reconnect_delay=1,
+                reconnect_delay_max=10,
+            )
+            await client.connect()
+            if not client.connected:
+                client.close()
+                raise ConnectionException("cannot connect to {}:{}".format(host, port))
+            self.clients[key] = client
+        return client
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+
+
+class TankMonitor:
+    def __init__(self, name, section, sampler, delta):
+        self.name = name
+        self.inputRate = section['inputRate']
+        self.dilutionRate = section['dilutionRate']
+        self.update = section.get('update', 1.0)
+        self.sampler = sampler
+        self.section = section
+
+        self.tankState = None
+        self.kalman = None
+        self.statefulDetector = StatefulDetector(threshold = section.get('statefulThreshold', 2000))
+        self.statefulDetector.set_delta(delta)
+        self.pipeline = DetectorPipeline()
+        self.pipeline.add(name + " stateless", StatelessDetector(threshold = section.get('statelessThreshold', 2000)), H_CONCENTRATION, [log_alarm])
+        self.pipeline.add(name + " stateful", self.statefulDetector, H_CONCENTRATION, [self.on_alarm])
+
+        self.samples = 0
+        self.errors = 0
+        self.alarm = None           # sample count at the first stateful alarm
+        self.pH = None
+
+    def on_alarm(self, alarm):
+        if self.alarm is None:
+            self.alarm = self.samples
+            print("ALERT: {}: Stateful detector: {}".format(self.name, alarm.detector.get_deviation()))
+
+    async def poll(self):
+        sample = await self.sampler.sample()
+        registers = sample.registers
+        self.samples += 1
+
+        if self.tankState is None:
+            # first sample: start the predictor from the measured state
+            self.tankState = TankStateClass()
+            self.tankState.set_client_cmd_coil(sample.coil)
+            self.tankState.set_hcl_input(sample.hcl_input)
+            self.tankState.set_h_concentration(registers[0])
+            self.tankState.set_hcl_concentration(registers[1])
+            if self.section.get('predictor') == 'kalman':
+                self.kalman = KalmanPredictor(self.inputRate, self.dilutionRate, self.update, registers, sample.coil,
+                                              self.section['processNoise'], self.section['measurementNoise'],
+                                              self.section['innovationGate'], self.section['kalmanResetAfter'])
+            return
+
+        self.tankState.set_client_cmd_coil(sample.coil)
+        self.tankState.update_state(self.inputRate, self.dilutionRate, self.update)
+        predicted_reg = self.tankState.get_concentrations()
+        if self.kalman is not None:
+            predicted_reg = self.kalman.predict(sample.coil)
+        if registers[0] > 0:
+            self.pH = -math.log10(registers[0] / (10**11))
+
+        self.pipeline.process(registers, predicted_reg, sample.timestamp)
+        if self.kalman is not None:
+            self.kalman.correct(registers)
+
+        if registers[0] > hConcentrationThresholdHigh:
+            await self.sampler.write_coil(False)
+        elif registers[0] < hConcentrationThresholdLow:
+            await self.sampler.write_coil(True)
+
+
+async def build_monitors(config, pool, clock, host, port, delta):
+    if 'tanks' in config:
+        entries, sections = config['tanks'], tank_sections(config)
+    else:
+        entries, sections = [{}], [dict(config, slave=1)]
+    monitors = []
+    for entry, section in zip(entries, sections):
+        # only a tank's own entry moves it off the command line endpoint
+        tankHost = entry.get('host', host)
+        tankPort = entry.get('port', port)
+        client = await pool.get(tankHost, tankPort)
+        registerMap = dict(section.get('registerMap', {}), slave=section['slave'])
+        sampler = TankSampler(client, registerMap, mode=section.get('acquisition', 'sequential'), clock=clock)
+        # --delta applies to every tank, otherwise each tank's calibrated one
+        tankDelta = delta if delta is not None else section.get('delta', 0)
+        monitors.append(TankMonitor("{}:{}/{}".format(tankHost, tankPort, section['slave']), section, sampler, tankDelta))
+    return monitors
+
+
+async def supervise(monitors, scheduler, max_inflight):
+    inflight = asyncio.Semaphore(max_inflight)
+
+    async def poll(monitor):
+        async with inflight:
+            try:
+                await monitor.poll()
+            except ModbusException as e:
+                # a tank that does not answer is retried next tick
+                monitor.errors += 1
+                _logger.warning("%s: %s", monitor.name, e)
+
+    counts = None
+    while True:
+        lateness = await scheduler.wait()
+        _logger.debug("fleet poll %d started %.6fs late", scheduler.ticks, lateness)
+        await asyncio.gather(*[poll(monitor) for monitor in monitors])
+
+        alarms = sum(1 for monitor in monitors if monitor.alarm is not None)
+        errors = sum(monitor.errors for monitor in monitors)
+        _logger.debug("fleet poll %d: %d tanks, %d alarms, %d errors", scheduler.ticks, len(monitors), alarms, errors)
+        # the console only hears about polls that changed the counts
+        if (alarms, errors) != counts:
+            counts = (alarms, errors)
+            print("Poll {}: {} tanks, {} alarms, {} errors".format(scheduler.ticks, len(monitors), alarms, errors))
+
+
+def report(monitors):
+    for monitor in monitors:
+        if monitor.alarm is not None:
+            print("{}: alarm after {} samples, deviation {}".format(
+                monitor.name, monitor.alarm, monitor.statefulDetector.get_deviation()))
+
+
+async def main(cmdline=None):
+    args = helper.get_commandline(
+        server=False,
+        description="Monitor a fleet of tanks.",
+        extras=[("--max-inflight", {"help": "maximum number of samples in flight", "dest": "max_inflight",
+                                    "default": 64, "type": int})],
+        cmdline=cmdline,
+    )
+    if args.file is None:
+        print("a config file is needed, see --file")
+        sys.exit(1)
+    config = ConfigWatcher(os.path.join('.', args.file)).get()
+
+    clock = get_clock(config, 'client')
+    pool = ConnectionPool(timeout=args.timeout)
+    monitors = await build_monitors(config, pool, clock, args.host, args.port, args.delta)
+    scheduler = DeadlineScheduler(config.get('update', 1.0) * 10, clock, policy=config.catchUp)
+    try:
+        await supervise(monitors, scheduler, args.max_inflight)
+    finally:
+        report(monitors)
+        pool.close()
+
+
+if __name__ == "__main__":
+    setup_logging('logs/fleet_monitor.log')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
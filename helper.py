@@ -72,7 +72,8 @@ def get_commandline(server=False, description=None, extras=None, cmdline=None):
     )
     parser.add_argument(
         "--delta",
-        default=0,
+        help="stateful detector delta, default is the config's \"delta\" or 0",
+        default=None,
         type=int,
     )
     if server:
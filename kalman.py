@@ -0,0 +1,158 @@
+"""Measurement-corrected prediction of the tank concentrations.
+
+The client's TankStateClass starts from the first sample and then runs
+open-loop: anything the model misses (a lost update, a restarted tank,
+sensor noise) stays in the prediction for good and the stateful detector
+keeps summing it. KalmanBank tracks x = (hConcentration, hclConcentration)
+of N tanks with a Kalman filter instead:
+
+    predict     the mean goes through the exact integer dynamics of
+                TankBatchClass (so with a perfect model the residuals stay 0),
+                the covariance through the affine step matrix A of
+                tank_state.affine_step_matrix: P = A P A' + Q
+    correct     z = x + v with both registers measured; the mean and P move
+                toward the measurement by the Kalman gain
+
+A measurement whose innovation is further than `gate` (squared Mahalanobis
+distance, 13.8 is the 99.9% point for two registers) is not used, so an
+attack is not absorbed into the prediction and its residuals persist like
+with the open-loop twin. P levels off at a few times Q while measurements
+are rejected, so the gate alone would never let the filter back onto a tank
+whose concentrations really jumped. After `resetAfter` rejections in a row
+a tank is re-initialised from its measurement instead. An attack that lasts
+that long becomes the new reference too, so the detectors have resetAfter
+samples to alarm on it. A lasting model error per update (changed rates)
+larger than the gate allows needs a larger processNoise; otherwise the
+filter only catches up at every reset.
+
+The residual for the detectors is measurement minus the prediction made
+before correcting with it.
+
+usage::
+
+    kalman = KalmanPredictor(inputRate, dilutionRate, update, registers, cmd)
+    predicted_reg = kalman.predict(cmd, periods)
+    pipeline.process(registers, predicted_reg, timestamp)
+    kalman.correct(registers)
+
+    bank = KalmanBank(inputRates, dilutionRates, updates, h, hcl)   # N tanks
+    predictedH, predictedHCl = bank.predict(cmds)
+    bank.correct(measuredH, measuredHCl)
+"""
+import numpy as np
+
+from tank_batch import TankBatchClass
+
+
+CHI2_2DOF_999 = 13.8
+RESET_AFTER = 300       # gated rejections in a row before a tank is re-initialised from its measurement
+
+
+class KalmanBank:
+    def __init__(self, inputRate, dilutionRate, updateRate, hConcentration, hclConcentration, cmd=1,
+                 processNoise=1.0, measurementNoise=1.0, gate=CHI2_2DOF_999, initialVariance=None, resetAfter=RESET_AFTER):
+        assert processNoise >= 0.0, "processNoise should be non-negative"
+        assert resetAfter is None or resetAfter >= 1, "resetAfter should be at least 1"
+        assert measurementNoise > 0.0, "measurementNoise should be positive"
+        assert gate is None or gate > 0.0, "gate should be positive"
+        self.batch = TankBatchClass(inputRate, dilutionRate, updateRate, hConcentration, hclConcentration, cmd)
+        n = len(self.batch)
+
+        self.x = np.stack(self.batch.get_concentrations(), axis=1).astype(np.float64)    # (N, 2)
+        self.initialVariance = measurementNoise if initialVariance is None else initialVariance
+        self.P = np.zeros((n, 2, 2))
+        self.P[:, 0, 0] = self.P[:, 1, 1] = self.initialVariance
+        self.Q = np.eye(2) * processNoise
+        self.R = np.eye(2) * measurementNoise
+        self.gate = gate
+        self.resetAfter = resetAfter
+        self.misses = np.zeros(n, dtype=np.int64)     # gated rejections in a row, per tank
+
+        # the linear part of tank_state.affine_step_matrix, per tank; it does not depend on the pump
+        b = self.batch
+        self.A = np.zeros((n, 2, 2))
+        self.A[:, 0, 0] = b.dilutionKeep
+        self.A[:, 0, 1] = b.dilutionKeep * b.dissociation
+        self.A[:, 1, 1] = b.dilutionKeep * b.hclKeep
+
+        self.prior = self.x.copy()
+        self.accepted = 0
+        self.rejected = 0
+        self.resets = 0
+
+    def __len__(self):
+        return len(self.x)
+
+    def predict(self, cmd=None, k=1):
+        """Advance every tank k updates with the pump held at cmd; returns the predicted (h, hcl) int arrays."""
+        assert k >= 1, "k should be at least 1"
+        b = self.batch
+        b.h = np.rint(self.x[:, 0]).astype(np.int64)
+        b.hcl = np.rint(self.x[:, 1]).astype(np.int64)
+        if cmd is not None:
+            b.set_client_cmd_coils(cmd)
+        for _ in range(k):
+            b.step()
+            self.P = self.A @ self.P @ self.A.transpose(0, 2, 1) + self.Q
+        self.x = np.stack((b.h, b.hcl), axis=1).astype(np.float64)
+        self.prior = self.x.copy()
+        return b.get_concentrations()
+
+    def correct(self, hConcentration, hclConcentration, mask=None):
+        """Update with the measured registers of the tanks in mask (default: all); returns the accepted mask."""
+        z = np.stack((np.asarray(hConcentration), np.asarray(hclConcentration)), axis=1).astype(np.float64)
+        innovation = z - self.prior
+        S = self.P + self.R
+        # closed-form inverse of the 2x2 innovation covariances
+        det = S[:, 0, 0] * S[:, 1, 1] - S[:, 0, 1] * S[:, 1, 0]
+        Sinv = np.empty_like(S)
+        Sinv[:, 0, 0] = S[:, 1, 1] / det
+        Sinv[:, 1, 1] = S[:, 0, 0] / det
+        Sinv[:, 0, 1] = -S[:, 0, 1] / det
+        Sinv[:, 1, 0] = -S[:, 1, 0] / det
+
+        considered = np.ones(len(self), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        accepted = considered.copy()
+        if self.gate is not None:
+            distance = np.einsum('ni,nij,nj->n', innovation, Sinv, innovation)
+            accepted &= distance <= self.gate
+
+        K = self.P @ Sinv
+        x = self.prior + np.einsum('nij,nj->ni', K, innovation)
+        P = self.P - K @ self.P
+        self.x[accepted] = x[accepted]
+        self.P[accepted] = P[accepted]
+
+        rejected = considered & ~accepted
+        self.misses[accepted] = 0
+        self.misses[rejected] += 1
+        if self.resetAfter is not None:
+            # the prediction has lost the tank: start over from the measurement
+            reset = self.misses >= self.resetAfter
+            if reset.any():
+                self.x[reset] = z[reset]
+                self.P[reset] = np.eye(2) * self.initialVariance
+                self.misses[reset] = 0
+                self.resets += int(reset.sum())
+
+        self.accepted += int(accepted.sum())
+        self.rejected += int(rejected.sum())
+        return accepted
+
+    def get_concentrations(self):
+        return (self.x[:, 0].copy(), self.x[:, 1].copy())
+
+
+class KalmanPredictor:
+    """KalmanBank of one tank, with the tuples client_async.py uses for predicted_reg."""
+    def __init__(self, inputRate, dilutionRate, updateRate, registers, cmd=1,
+                 processNoise=1.0, measurementNoise=1.0, gate=CHI2_2DOF_999, resetAfter=RESET_AFTER):
+        self.bank = KalmanBank(inputRate, dilutionRate, updateRate, registers[0], registers[1], 1 if cmd else 0,
+                               processNoise, measurementNoise, gate, resetAfter=resetAfter)
+
+    def predict(self, cmd, k=1):
+        h, hcl = self.bank.predict(1 if cmd else 0, k)
+        return (int(h[0]), int(hcl[0]))
+
+    def correct(self, registers):
+        return bool(self.bank.correct([registers[0]], [registers[1]])[0])
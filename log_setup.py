@@ -0,0 +1,92 @@
+"""Off-loop logging and the debug/production switch.
+
+setup_logging() routes every record through a QueueHandler; a QueueListener
+thread does the file I/O, into a size-rotated log, so a log call on the
+event loop only appends to a queue.
+
+"logMode" in the config selects:
+
+    debug       DEBUG records, asyncio debug mode, per-tick console output
+                (the original behaviour, default)
+    production  INFO records, no asyncio debug (no slow-callback tracking),
+                and per-tick/per-packet messages go to the log at most once
+                per interval per message instead of to the console
+
+usage::
+
+    setup_logging('logs/async_client.log')
+    hotPath = HotPath(_logger)
+    ...
+    hotPath.production = set_log_mode(dtDict.logMode)
+    hotPath("Tank State      %s", registers)
+"""
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+
+LOG_MODES = ('debug', 'production')
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+
+def setup_logging(path, max_bytes=10 * 1024 * 1024, backup_count=3, level=logging.DEBUG):
+    """Send all records to a rotating file at path, written from a listener thread."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    fileHandler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    fileHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, fileHandler, respect_handler_level=True)
+    _listener.start()
+    # stop() drains the queue, so records logged right before exit are kept
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def set_log_mode(mode):
+    """Apply mode to the root logger and the running loop; True in production."""
+    assert mode in LOG_MODES, "logMode should be one of {}".format(LOG_MODES)
+    production = mode == 'production'
+    logging.getLogger().setLevel(logging.INFO if production else logging.DEBUG)
+    try:
+        asyncio.get_running_loop().set_debug(not production)
+    except RuntimeError:
+        pass    # no loop yet, asyncio.run(debug=...) decides
+    return production
+
+
+class HotPath:
+    """Per-tick messages: printed in debug mode, rate limited into the log in production."""
+    def __init__(self, logger, interval=10.0, production=False):
+        self.logger = logger
+        self.interval = interval
+        self.production = production
+        self.last = {}          # message format -> time it was last logged
+        self.suppressed = {}    # message format -> calls dropped since then
+
+    def __call__(self, msg, *args):
+        if not self.production:
+            print(msg % args if args else msg)
+            return
+        now = time.monotonic()
+        if now - self.last.get(msg, -self.interval) < self.interval:
+            self.suppressed[msg] = self.suppressed.get(msg, 0) + 1
+            return
+        self.last[msg] = now
+        dropped = self.suppressed.pop(msg, 0)
+        if dropped:
+            self.logger.info(msg + " (%d similar suppressed)", *args, dropped)
+        else:
+            self.logger.info(msg, *args)
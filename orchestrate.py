@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Run tank/MITM/client trials in parallel, replacing data.sh.
+
+Every trial gets its own working directory (its dt.json, logs/ and data/)
+and its own free ports, so any number of trials can run side by side. A
+process is started once the one before it accepts connections, instead of
+after a random sleep, and the results of all trials are collected as JSON
+lines.
+
+usage::
+
+    orchestrate.py --config dt.json --deltas 0 20 40 1000 --trials 5 [--jobs N]
+                   [--no-mitm] [--timeout 600] [--results results.jsonl] [--output data.txt]
+
+--warmup MAX waits a seeded random 0..MAX seconds between the MITM and the
+client, like the random sleeps of data.sh, so trials start from different
+tank states. A config with "clock": "virtual" runs each trial faster than
+real time; every trial has its own clock file.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+
+from sweep import DATA_SH_DELTAS
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT_RANGE = (5100, 10000)          # dt_config accepts ports in (5000, 10000)
+RESULT_LINE = re.compile(r"Delta: (-?\d+), Deviation: (-?\d+)")
+
+Trial = namedtuple('Trial', ['index', 'delta', 'trial', 'seed'])
+
+
+class PortAllocator:
+    """Hands out ports in PORT_RANGE that are free now and not given out before."""
+    def __init__(self, first=PORT_RANGE[0], last=PORT_RANGE[1]):
+        self.next = first
+        self.last = last
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            while self.next < self.last:
+                port = self.next
+                self.next += 1
+                with socket.socket() as s:
+                    try:
+                        s.bind(('127.0.0.1', port))
+                    except OSError:
+                        continue
+                return port
+        raise RuntimeError("no free port left in {}".format(PORT_RANGE))
+
+
+def wait_for_port(port, process, timeout=30.0):
+    """Readiness probe: block until something accepts on port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("process exited with {} before listening on {}".format(process.returncode, port))
+        with socket.socket() as s:
+            s.settimeout(0.5)
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError("nothing listening on port {} after {}s".format(port, timeout))
+
+
+def start(script, args, workdir, name):
+    log = open(os.path.join(workdir, name + ".out"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)] + args,
+                               cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()     # the child has its own descriptor
+    return process
+
+
+def stop(process):
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def parse_result(workdir):
+    """(delta, deviation) of the client's data.txt line, None if it never detected."""
+    try:
+        with open(os.path.join(workdir, "data.txt"), "r") as file:
+            match = RESULT_LINE.search(file.read())
+    except OSError:
+        return None
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def run_trial(trial, config, ports, root, mitm=True, warmup=0.0, timeout=600.0):
+    workdir = os.path.join(root, "trial-{:04d}".format(trial.index))
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+
+    tankPort = ports.allocate()
+    mitmPort = ports.allocate() if mitm else None
+    trialConfig = dict(config, port=tankPort)
+    with open(os.path.join(workdir, "dt.json"), "w") as file:
+        json.dump(trialConfig, file)
+
+    result = {'index': trial.index, 'delta': trial.delta, 'trial': trial.trial, 'seed': trial.seed,
+              'workdir': workdir, 'tankPort': tankPort, 'mitmPort': mitmPort}
+    tank = proxy = client = None
+    started = time.monotonic()
+    try:
+        tank = start("waterTank.py", ["dt.json", "-p", str(tankPort)], workdir, "tank")
+        wait_for_port(tankPort, tank)
+        if mitm:
+            proxy = start("mitm_async.py", ["--file", "dt.json", "--port", str(mitmPort),
+                                            "--server-port", str(tankPort)], workdir, "mitm")
+            wait_for_port(mitmPort, proxy)
+        if warmup > 0.0:
+            time.sleep(random.Random(trial.seed).uniform(0.0, warmup))
+
+        client = start("client_async.py", ["-c", "tcp", "-p", str(mitmPort if mitm else tankPort),
+                                           "--file", "dt.json", "--delta", str(trial.delta)], workdir, "client")
+        try:
+            result['returncode'] = client.wait(timeout=timeout)
+            result['timedOut'] = False
+        except subprocess.TimeoutExpired:
+            result['returncode'] = None
+            result['timedOut'] = True
+    except RuntimeError as e:
+        result['error'] = str(e)
+    finally:
+        for process in (client, proxy, tank):
+            stop(process)
+
+    result['seconds'] = round(time.monotonic() - started, 3)
+    detection = parse_result(workdir)
+    result['detected'] = detection is not None
+    result['deviation'] = detection[1] if detection is not None else None
+    return result
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description="Run tank/MITM/client trials in parallel.")
+    parser.add_argument("--config", default="dt.json", help="base config of every trial")
+    parser.add_argument("--deltas", nargs='+', type=int, default=list(DATA_SH_DELTAS))
+    parser.add_argument("--trials", type=int, default=5, help="trials per delta")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="trials run at once, default: cores")
+    parser.add_argument("--no-mitm", dest="mitm", action="store_false", help="client talks to the tank directly")
+    parser.add_argument("--warmup", type=float, default=0.0, help="random wait before the client, up to this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds a client may run without detecting")
+    parser.add_argument("--workdir", default=None, help="where the trial directories go, default: a new temp dir")
+    parser.add_argument("--results", default=None, help="write one JSON result per trial to this file")
+    parser.add_argument("--output", default=None, help="append the data.txt lines of the trials to this file")
+    parser.add_argument("--clean", action="store_true", help="remove the trial directories afterwards")
+    args = parser.parse_args(cmdline)
+    assert args.jobs > 0, "jobs should be positive"
+
+    with open(args.config, "r") as file:
+        config = json.load(file)
+    root = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="trials-")
+    os.makedirs(root, exist_ok=True)
+
+    trials = [Trial(i, delta, n, args.seed * 1000003 + i)
+              for i, (delta, n) in enumerate((delta, n) for delta in args.deltas for n in range(args.trials))]
+    ports = PortAllocator()
+    print("{} trials, {} at a time, in {}".format(len(trials), args.jobs, root))
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_trial, trial, config, ports, root, args.mitm, args.warmup, args.timeout)
+                   for trial in trials]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.results is not None:
+        with open(args.results, "w") as file:
+            file.write("".join(json.dumps(result) + "\n" for result in results))
+    if args.output is not None:
+        with open(args.output, "a") as file:
+            for result in results:
+                if result['detected']:
+                    file.write("Delta: {}, Deviation: {}\n".format(result['delta'], result['deviation']))
+
+    detected = sum(1 for result in results if result['detected'])
+    print("{}/{} trials detected".format(detected, len(results)))
+    if args.clean:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
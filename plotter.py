@@ -1,25 +1,41 @@
 import argparse
+import os
 import matplotlib.pyplot as plt
 import pandas as pd
+from ts_store import TimeSeriesStore
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="Plot pH and Pump State from time series data.")
-parser.add_argument("data_location", type=str, help="Path to the CSV data file")
+parser.add_argument("data_location", type=str, help="Path to the CSV data file or columnar store directory")
+parser.add_argument("--start", type=float, default=None, help="First second to plot, relative to the first sample")
+parser.add_argument("--end", type=float, default=None, help="Last second to plot, relative to the first sample")
 args = parser.parse_args()
 
-# Load data from the CSV file
-data = pd.read_csv(args.data_location)
-
-# Dynamically set headers based on the number of columns
-if data.shape[1] == 3:
-    data.columns = ["Time", "pH", "Pump State"]
-elif data.shape[1] == 2:
-    data.columns = ["Time", "pH"]
+if os.path.isdir(args.data_location):
+    # Columnar store: only the requested time window is read from the mapped files
+    store = TimeSeriesStore(args.data_location)
+    t0 = store.time_range()[0] if len(store) else 0.0
+    window = store.slice(None if args.start is None else t0 + args.start,
+                         None if args.end is None else t0 + args.end)
+    data = pd.DataFrame({"Time": window["time"] - t0, "pH": window["pH"], "Pump State": window["pump"]})
 else:
-    raise ValueError("Unsupported number of columns in the data file. Expected 2 or 3 columns.")
+    # Load data from the CSV file
+    data = pd.read_csv(args.data_location)
+
+    # Dynamically set headers based on the number of columns
+    if data.shape[1] == 3:
+        data.columns = ["Time", "pH", "Pump State"]
+    elif data.shape[1] == 2:
+        data.columns = ["Time", "pH"]
+    else:
+        raise ValueError("Unsupported number of columns in the data file. Expected 2 or 3 columns.")
 
-# Convert time to relative time (starting from 0)
-data["Time"] -= data["Time"].min()
+    # Convert time to relative time (starting from 0)
+    data["Time"] -= data["Time"].min()
+    if args.start is not None:
+        data = data[data["Time"] >= args.start]
+    if args.end is not None:
+        data = data[data["Time"] <= args.end]
 
 # Convert pump state to numeric for plotting if the column exists
 if "Pump State" in data.columns:
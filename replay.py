@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Replay recorded residual traces through the detectors, offline.
+
+With "residuals": 1 in its config the client records the measured and
+predicted H and HCl concentrations of every poll (data/residuals.csv, or
+data/residuals.ts with "telemetry": "columnar"). This module runs the
+StatelessDetector and StatefulDetector of detector.py over such a trace as
+whole-array NumPy operations, with the same results as feeding the samples
+one by one:
+
+    stateless   alarm wherever |actual - predicted| > threshold
+    stateful    S_n = max(0, S_(n-1) + |r_n| - delta) is the Lindley
+                recursion, whose closed form with C_n = cumsum(|r| - delta)
+                is S_n = C_n - min(-S_0, min_(k<=n) C_k)
+                (numpy.minimum.accumulate); alarm wherever S_n > threshold.
+                The deviation is the sum of |r| before the first alarm.
+
+usage::
+
+    replay.py data/residuals.csv --threshold 2000 --delta 1000 [--register H]
+"""
+import argparse
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from detector import StatelessDetector, StatefulDetector, lindley
+from ts_store import TimeSeriesStore, RESIDUAL_COLUMNS
+
+
+REGISTERS = ('H', 'HCl')
+
+ReplayResult = namedtuple('ReplayResult', ['alarms', 'alarm_times', 'first_alarm_time', 'deviation', 'statistic'])
+
+
+def load_trace(path):
+    """Columns of a recorded residual trace, CSV file or columnar store directory."""
+    if os.path.isdir(path):
+        store = TimeSeriesStore(path)
+        return {name: store.columns[name] for name, _ in RESIDUAL_COLUMNS}
+    values = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    return {name: values[:, i].astype(dtype) for i, (name, dtype) in enumerate(RESIDUAL_COLUMNS)}
+
+
+def residuals(trace, register='H'):
+    assert register in REGISTERS, "register should be one of {}".format(REGISTERS)
+    # int64, so the cumulative sums below stay exact
+    actual = np.asarray(trace['actual' + register], dtype=np.int64)
+    predicted = np.asarray(trace['predicted' + register], dtype=np.int64)
+    return np.abs(actual - predicted)
+
+
+def cusum(residual, delta, initial=0):
+    """S_n of StatefulDetector for every sample, without a Python loop."""
+    return lindley(residual - delta, initial)
+
+
+def deviation_before(residual, alarms):
+    """StatefulDetector.deviation: the residuals summed up to the first alarm."""
+    end = alarms[0] if len(alarms) else len(residual)
+    return residual[:end].sum()
+
+
+def replay(trace, detector, register='H'):
+    """Run one StatelessDetector or StatefulDetector over a whole trace."""
+    residual = residuals(trace, register)
+    if isinstance(detector, StatefulDetector):
+        statistic = cusum(residual, detector.get_delta(), detector.residual)
+    elif isinstance(detector, StatelessDetector):
+        statistic = residual
+    else:
+        # other detectors report alarms only: in one call when they have detect_many, else sample by sample
+        actual, predicted = trace['actual' + register], trace['predicted' + register]
+        if hasattr(detector, 'detect_many'):
+            statistic = detector.detect_many(actual, predicted).astype(np.int64)
+        else:
+            statistic = np.asarray([detector.detect(a, p) for a, p in zip(actual, predicted)], dtype=np.int64)
+        alarms = np.flatnonzero(statistic)
+        return make_result(trace, residual, alarms, statistic)
+    alarms = np.flatnonzero(statistic > detector.threshold)
+    return make_result(trace, residual, alarms, statistic)
+
+
+def make_result(trace, residual, alarms, statistic):
+    times = np.asarray(trace['time'])[alarms]
+    return ReplayResult(alarms, times, float(times[0]) if len(times) else None,
+                        int(deviation_before(residual, alarms)), statistic)
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded residual trace through the detectors.")
+    parser.add_argument("trace", type=str, help="data/residuals.csv or a columnar data/residuals.ts directory")
+    parser.add_argument("--threshold", type=float, default=2000)
+    parser.add_argument("--delta", type=int, default=0)
+    parser.add_argument("--register", choices=REGISTERS, default='H')
+    args = parser.parse_args(cmdline)
+
+    trace = load_trace(args.trace)
+    print("{} samples".format(len(trace['time'])))
+
+    stateless = replay(trace, StatelessDetector(threshold = args.threshold), args.register)
+    print("Stateless: {} alarms, first at {}".format(len(stateless.alarms), stateless.first_alarm_time))
+
+    statefulDetector = StatefulDetector(threshold = args.threshold)
+    statefulDetector.set_delta(args.delta)
+    stateful = replay(trace, statefulDetector, args.register)
+    print("Stateful: {} alarms, first at {}".format(len(stateful.alarms), stateful.first_alarm_time))
+    print("Delta: {}, Deviation: {}".format(args.delta, stateful.deviation))
+
+
+if __name__ == "__main__":
+    main()
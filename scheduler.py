@@ -0,0 +1,95 @@
+"""Absolute-deadline scheduling for periodic loops.
+
+Sleeping a fixed period after doing the work makes every tick last
+period + work time, so the loop drifts. DeadlineScheduler sleeps until the
+next point of a fixed grid start + n * period instead, and records how late
+every tick started. When the loop falls behind by more than a period, the
+catch-up policy decides what happens:
+
+    skip    drop the missed ticks and continue on the grid (default)
+    burst   run the missed ticks back to back until caught up
+    slew    shorten the following periods by at most max_slew * period
+            until the loop is back on the grid
+
+usage::
+
+    scheduler = DeadlineScheduler(update * 10, clock, policy='skip')
+    while True:
+        await scheduler.wait()
+        ...
+"""
+import math
+
+from sim_clock import RealClock
+
+
+class DeadlineScheduler:
+    def __init__(self, period, clock=None, policy='skip', max_slew=0.1):
+        assert period > 0.0, "period should be positive"
+        assert policy in ('skip', 'burst', 'slew'), "policy should be 'skip', 'burst' or 'slew'"
+        assert 0.0 < max_slew < 1.0, "max_slew should be in (0, 1)"
+        self.period = period
+        self.clock = clock if clock is not None else RealClock()
+        self.policy = policy
+        self.max_slew = max_slew
+
+        self.start = None
+        self.n = 0              # index of the next grid point
+        self.deadline = None    # when the next tick will actually be released
+
+        # lateness accounting, in seconds behind the grid
+        self.ticks = 0
+        self.missed = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def grid(self, n):
+        # computed, not accumulated, so no rounding drift builds up
+        return self.start + n * self.period
+
+    async def wait(self, periods=1):
+        """Sleep until the next tick and return how late it started.
+
+        periods > 1 skips the ticks in between, e.g. for adaptive polling.
+        """
+        assert periods >= 1, "periods should be at least 1"
+        if self.start is None:
+            self.start = self.clock.now()
+            self.n = 1
+            self.deadline = self.grid(1)
+        if periods > 1:
+            self.n += periods - 1
+            self.deadline = max(self.deadline, self.grid(self.n))
+
+        await self.clock.sleep_until(self.deadline)
+        now = self.clock.now()
+
+        lateness = max(0.0, now - self.grid(self.n))
+        self.ticks += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+
+        self.n += 1
+        if self.policy == 'skip':
+            behind = math.floor((now - self.grid(self.n)) / self.period) + 1
+            if behind > 0:
+                self.missed += behind
+                self.n += behind
+            self.deadline = self.grid(self.n)
+        elif self.policy == 'burst':
+            self.deadline = self.grid(self.n)
+        else:
+            self.deadline = max(self.grid(self.n), now + self.period * (1 - self.max_slew))
+
+        return lateness
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+            'mean_lateness': self.total_lateness / self.ticks if self.ticks else 0.0,
+        }
@@ -0,0 +1,158 @@
+"""Real and virtual clocks for the tank, client and MITM.
+
+By default every process uses RealClock: time.time() and asyncio.sleep().
+
+With "clock": "virtual" in the config, the processes share a VirtualClock
+kept in a small memory-mapped file ("clockFile", default logs/clock.bin).
+Virtual time only moves when every registered participant (the tank and the
+client) is sleeping, and then it jumps straight to the earliest wake-up time,
+so a scenario runs as fast as the CPU allows. Participants that wake at the
+same virtual time run in slot order (tank before client), which keeps the
+tick-then-poll ordering of a real-time run. The MITM only reads the time.
+
+usage::
+
+    clock = get_clock(dtDict, 'tank')
+    await clock.sleep(update * 10)
+    current_time = clock.now()
+"""
+import asyncio
+import atexit
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+
+
+# participants that sleep on the clock, in the order they run at equal times
+CLOCK_SLOTS = {'tank': 0, 'client': 1}
+DEFAULT_CLOCK_FILE = os.path.join('logs', 'clock.bin')
+
+MAGIC = b'TANKCLK1'
+HEADER = struct.Struct('<8sdI4x')   # magic, virtual now, number of slots
+SLOT = struct.Struct('<d')          # wake-up time of one participant
+
+UNREGISTERED = -1.0                 # slot not joined yet, virtual time is held
+LEFT = math.inf                     # participant exited, ignored from now on
+
+
+class ManualClock:
+    """Time that only moves when advance() is called, for in-process simulations."""
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def advance(self, delay):
+        self.time += delay
+
+    async def sleep(self, delay):
+        self.advance(delay)
+
+    async def sleep_until(self, deadline):
+        self.time = max(self.time, deadline)
+
+    def close(self):
+        pass
+
+
+class RealClock:
+    def now(self):
+        return time.time()
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+    async def sleep_until(self, deadline):
+        await asyncio.sleep(max(0.0, deadline - time.time()))
+
+    def close(self):
+        pass
+
+
+class VirtualClock:
+    def __init__(self, path, slot=None, create=False, poll=0.0005, timeout=60.0):
+        self.path = path
+        self.slot = slot
+        self.poll = poll
+        slots = len(CLOCK_SLOTS)
+
+        if create:
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, time.time(), slots))
+                f.write(SLOT.pack(UNREGISTERED) * slots)
+        else:
+            # the tank creates the clock, the others wait for it to show up
+            deadline = time.monotonic() + timeout
+            while not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("virtual clock file {} not found".format(path))
+                time.sleep(0.05)
+
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, _, self.slots = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise RuntimeError("{} is not a virtual clock file".format(path))
+
+    def now(self):
+        return HEADER.unpack_from(self.map, 0)[1]
+
+    def _wake(self, slot):
+        return SLOT.unpack_from(self.map, HEADER.size + SLOT.size * slot)[0]
+
+    def _set_wake(self, slot, wake):
+        SLOT.pack_into(self.map, HEADER.size + SLOT.size * slot, wake)
+
+    def _advance(self):
+        """Move virtual time to the earliest wake-up once everyone is asleep."""
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            now = self.now()
+            wakes = [self._wake(slot) for slot in range(self.slots)]
+            if all(wake != UNREGISTERED and wake > now for wake in wakes):
+                earliest = min(wakes)
+                if earliest != LEFT:
+                    now = earliest
+                    HEADER.pack_into(self.map, 0, MAGIC, now, self.slots)
+            return now
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    async def sleep(self, delay):
+        await self.sleep_until(self.now() + delay)
+
+    async def sleep_until(self, wake):
+        assert self.slot is not None, "only clock participants can sleep"
+        self._set_wake(self.slot, wake)
+        while True:
+            now = self._advance()
+            # due, and every participant that runs before us at this time is done
+            if now >= wake and all(self._wake(slot) > now for slot in range(self.slot)):
+                return
+            await asyncio.sleep(self.poll)
+
+    def close(self):
+        if self.slot is not None and not self.map.closed:
+            self._set_wake(self.slot, LEFT)
+            self.map.flush()
+
+
+def get_clock(dtDict, participant=None):
+    """Return the clock selected by the config for tank, client or an observer (None)."""
+    mode = dtDict.get('clock', 'real')
+    assert mode in ('real', 'virtual'), "clock should be 'real' or 'virtual'"
+    if mode == 'real':
+        return RealClock()
+
+    clock = VirtualClock(dtDict.get('clockFile', DEFAULT_CLOCK_FILE),
+                         slot=CLOCK_SLOTS.get(participant),
+                         create=participant == 'tank')
+    if clock.slot is not None:
+        # join now so virtual time waits for us, and leave cleanly on exit
+        clock._set_wake(clock.slot, clock.now())
+        atexit.register(clock.close)
+    return clock
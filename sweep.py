@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""StatefulDetector over a whole grid of delta and threshold values at once.
+
+data.sh restarts the tank, MITM and client for every delta just to get one
+"Delta: X, Deviation: Y" line. Given a recorded residual trace (see
+replay.py) the whole surface comes out of one pass:
+
+    C[d, n] = cumsum(|r| - delta_d)                 one row per delta
+    S[d, n] = C[d, n] - min(0, min_(k<=n) C[d, k])  the detector's residual
+    M[d, n] = max_(k<=n) S[d, k]                    nondecreasing
+
+so the first alarm for threshold t is searchsorted(M[d], t, 'right'), for
+every threshold at once, and the deviation is the prefix sum of |r| up to it.
+
+usage::
+
+    sweep.py data/residuals.csv [more traces] --deltas 0 20 40 100 1000 --thresholds 2000 [--output data.txt]
+"""
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from replay import load_trace, residuals, REGISTERS
+
+
+DATA_SH_DELTAS = (0, 20, 40, 60, 80, 100, 200, 300, 400, 500, 750, 1000)
+
+SweepResult = namedtuple('SweepResult', ['deltas', 'thresholds', 'first_alarm', 'detection_time', 'deviation'])
+
+
+def sweep(residual, deltas, thresholds, times=None):
+    """First alarm, detection time and deviation for every (delta, threshold) pair.
+
+    All three are (len(deltas), len(thresholds)) arrays. A pair that never
+    alarms has first_alarm == len(residual), detection_time NaN and the
+    deviation of the whole trace, as StatefulDetector would report it.
+    """
+    residual = np.asarray(residual, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=np.int64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    n = len(residual)
+
+    cumulative = np.cumsum(residual[None, :] - deltas[:, None], axis=1)
+    statistic = cumulative - np.minimum(np.minimum.accumulate(cumulative, axis=1), 0)
+    peak = np.maximum.accumulate(statistic, axis=1)
+
+    # one bisection per delta row covers every threshold
+    first_alarm = np.stack([np.searchsorted(row, thresholds, side='right') for row in peak])
+
+    prefix = np.concatenate(([0], np.cumsum(residual)))
+    deviation = prefix[first_alarm]
+
+    if times is None:
+        times = np.arange(n, dtype=np.float64)
+    times = np.append(np.asarray(times, dtype=np.float64), np.nan)
+    detection_time = times[first_alarm]
+    return SweepResult(deltas, thresholds, first_alarm, detection_time, deviation)
+
+
+def format_lines(result, start=0.0, detection=True):
+    """data.txt style lines, with the threshold when it varies."""
+    lines = []
+    for j, threshold in enumerate(result.thresholds):
+        for i, delta in enumerate(result.deltas):
+            line = "Delta: {}, Deviation: {}".format(delta, result.deviation[i, j])
+            if len(result.thresholds) > 1:
+                line = "Threshold: {:g}, ".format(threshold) + line
+            if detection:
+                seconds = result.detection_time[i, j] - start
+                line += ", Detection: {}".format("none" if np.isnan(seconds) else "{:.3f}s".format(seconds))
+            lines.append(line)
+    return lines
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description="Evaluate the stateful detector over a delta x threshold grid.")
+    parser.add_argument("traces", nargs='+', type=str, help="recorded residual traces (CSV or columnar store)")
+    parser.add_argument("--deltas", nargs='+', type=int, default=list(DATA_SH_DELTAS))
+    parser.add_argument("--thresholds", nargs='+', type=float, default=[2000])
+    parser.add_argument("--register", choices=REGISTERS, default='H')
+    parser.add_argument("--output", type=str, default=None, help="append the lines to this file, like data.txt")
+    args = parser.parse_args(cmdline)
+
+    for path in args.traces:
+        trace = load_trace(path)
+        times = np.asarray(trace['time'], dtype=np.float64)
+        result = sweep(residuals(trace, args.register), args.deltas, args.thresholds, times)
+        print("{}: {} samples".format(path, len(times)))
+        print("\n".join(format_lines(result, times[0] if len(times) else 0.0)))
+        if args.output is not None:
+            with open(args.output, "a") as file:
+                file.write("".join(line + "\n" for line in format_lines(result, detection=False)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Vectorized batch simulation of many water tanks.
+
+TankBatchClass advances N tanks at once with NumPy. Every tank has its own
+inputRate, dilutionRate, update and pump state. The arithmetic is done in
+the same order as TankStateClass.update_state and truncated to integers at
+the same points, so a batch run gives exactly the values of N scalar runs.
+
+usage::
+
+    batch = TankBatchClass(inputRate=[7000, 5000], dilutionRate=0.3,
+                           updateRate=0.1, hConcentration=10000)
+    hTraj, hclTraj = batch.run(100)     # arrays of shape (100, 2)
+"""
+import numpy as np
+
+from tank_state import *
+
+
+class TankBatchClass:
+    def __init__(self, inputRate, dilutionRate, updateRate, hConcentration=0, hclConcentration=0, cmd=1):
+        params = np.broadcast_arrays(
+            np.asarray(inputRate, dtype=np.float64),
+            np.asarray(dilutionRate, dtype=np.float64),
+            np.asarray(updateRate, dtype=np.float64),
+            np.asarray(hConcentration),
+            np.asarray(hclConcentration),
+            np.asarray(cmd),
+        )
+        params = [np.atleast_1d(p) for p in params]
+        assert params[0].ndim == 1, "tank parameters should be scalars or 1-d arrays"
+
+        self.updateRate = params[2].copy()
+        self.h = params[3].astype(np.int64)
+        self.hcl = params[4].astype(np.int64)
+        self.cmd = params[5].astype(bool)
+        self.hclInput = self.cmd.copy()
+
+        assert np.all((0.0 < self.updateRate) & (self.updateRate < 10.0)), "update should be positive and less than 10 seconds"
+
+        self.set_rates(params[0], params[1])
+
+    @classmethod
+    def from_tanks(cls, tanks, inputRate, dilutionRate, updateRate):
+        """Build a batch from the current state of TankStateClass objects."""
+        h, hcl = zip(*[tank.get_concentrations() for tank in tanks])
+        cmd = [tank.coils[CMD] for tank in tanks]
+        return cls(inputRate, dilutionRate, updateRate, h, hcl, cmd)
+
+    def set_rates(self, inputRate, dilutionRate):
+        """Change the inputRate and dilutionRate of every tank."""
+        inputRate = np.broadcast_to(np.asarray(inputRate, dtype=np.float64), self.h.shape)
+        dilutionRate = np.broadcast_to(np.asarray(dilutionRate, dtype=np.float64), self.h.shape)
+
+        assert np.all(inputRate > 0.0), "inputRate should be positive"
+        assert np.all(dilutionRate > 0.0), "dilutionRate should be positive"
+
+        self.inputRate = inputRate.copy()
+        self.dilutionRate = dilutionRate.copy()
+        self._precompute()
+
+    def _precompute(self):
+        # same sub-expressions, in the same order, as TankStateClass.update_state
+        self.inflow = (self.inputRate * self.updateRate).astype(np.int64)
+        self.dissociation = dissociationRate * self.updateRate
+        self.hclKeep = 1 - dissociationRate * self.updateRate
+        self.dilutionKeep = 1 - self.dilutionRate * self.updateRate
+        self.dilutionInflow = self.dilutionRate * self.updateRate * dilution_h_concentration
+
+    def __len__(self):
+        return len(self.h)
+
+    def set_client_cmd_coils(self, cmd):
+        self.cmd[:] = cmd
+
+    def get_concentrations(self):
+        return (self.h.copy(), self.hcl.copy())
+
+    def get_tank(self, i):
+        """Return tank i as a TankStateClass."""
+        tank = TankStateClass()
+        tank.set_client_cmd_coil(int(self.cmd[i]))
+        tank.set_hcl_input(int(self.hclInput[i]))
+        tank.set_h_concentration(int(self.h[i]))
+        tank.set_hcl_concentration(int(self.hcl[i]))
+        return tank
+
+    def step(self, cmd=None):
+        """Advance every tank by one update, optionally setting the pump commands first."""
+        if cmd is not None:
+            self.cmd[:] = cmd
+        self.hclInput[:] = self.cmd
+
+        hcl = self.hcl + self.inflow * self.hclInput
+        h = self.h + (self.dissociation * hcl).astype(np.int64)
+        hcl = (self.hclKeep * hcl).astype(np.int64)
+
+        self.h = (self.dilutionKeep * h + self.dilutionInflow).astype(np.int64)
+        self.hcl = (self.dilutionKeep * hcl).astype(np.int64)
+
+        return (self.h, self.hcl)
+
+    def run(self, steps, cmd=None):
+        """Advance every tank `steps` updates and return the (steps, N) trajectories.
+
+        cmd may be None (keep the current pump commands), an array of shape
+        (N,) applied at every step, or an array of shape (steps, N) giving the
+        pump command of every tank at every step.
+        """
+        n = len(self)
+        hTraj = np.empty((steps, n), dtype=np.int64)
+        hclTraj = np.empty((steps, n), dtype=np.int64)
+
+        schedule = None
+        if cmd is not None:
+            cmd = np.asarray(cmd, dtype=bool)
+            if cmd.ndim == 2:
+                assert cmd.shape == (steps, n), "cmd schedule should have shape (steps, N)"
+                schedule = cmd
+            else:
+                self.cmd[:] = cmd
+
+        for t in range(steps):
+            self.step(None if schedule is None else schedule[t])
+            hTraj[t] = self.h
+            hclTraj[t] = self.hcl
+
+        return (hTraj, hclTraj)
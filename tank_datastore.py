@@ -0,0 +1,72 @@
+"""Datastore block that holds one tank's whole register image.
+
+waterTank.py serves coils, discrete inputs and holding registers from the
+same sequential block. TankDataBlock keeps that layout but lets the update
+loop replace the whole image with one assignment per tick, instead of one
+getValues/setValues pair per kind of value. Readers therefore always see
+the values of a single tick.
+
+Addresses are the ones the client uses; unless zero_mode is set, the slave
+context adds one to them before they reach the block (Modbus section 4.4),
+so the image is laid out the same way.
+
+When read_histogram / write_histogram are set, every datastore access is
+timed into them.
+"""
+import time
+
+from pymodbus.datastore import ModbusSequentialDataBlock
+
+from tank_state import CMD, HCL
+
+
+class TankDataBlock(ModbusSequentialDataBlock):
+    def __init__(self, coil_address, input_address, reg_address, reg_count, zero_mode=False,
+                 read_histogram=None, write_histogram=None):
+        offset = 0 if zero_mode else 1
+        self.coil_index = coil_address + offset
+        self.input_index = input_address + offset
+        self.reg_index = reg_address + offset
+        self.reg_count = reg_count
+        self.size = self.reg_index + reg_count
+        self.read_histogram = read_histogram
+        self.write_histogram = write_histogram
+        super().__init__(0x00, [0] * self.size)
+
+    def getValues(self, address, count=1):
+        if self.read_histogram is None:
+            return super().getValues(address, count)
+        start = time.perf_counter()
+        values = super().getValues(address, count)
+        self.read_histogram.observe(time.perf_counter() - start)
+        return values
+
+    def setValues(self, address, values):
+        if self.write_histogram is None:
+            return super().setValues(address, values)
+        start = time.perf_counter()
+        super().setValues(address, values)
+        self.write_histogram.observe(time.perf_counter() - start)
+
+    def get_coil(self):
+        return self.values[self.coil_index]
+
+    def make_image(self, coil, hcl_input, registers):
+        image = [0] * self.size
+        image[self.coil_index] = coil
+        image[self.input_index] = hcl_input
+        image[self.reg_index:self.reg_index + self.reg_count] = registers
+        return image
+
+    def publish(self, image):
+        """Replace the whole register image in one write."""
+        assert len(image) == self.size, "image should cover the whole block"
+        if self.write_histogram is None:
+            self.values = image
+            return
+        start = time.perf_counter()
+        self.values = image
+        self.write_histogram.observe(time.perf_counter() - start)
+
+    def publish_tank(self, tankState):
+        self.publish(self.make_image(tankState.coils[CMD], tankState.inputs[HCL], tankState.registers.tolist()))
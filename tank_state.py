@@ -1,4 +1,7 @@
 
+from collections import OrderedDict
+from array import array
+
 global dissociationRate
 dissociationRate = 0.2
 dilution_h_concentration = 8000
@@ -15,58 +18,222 @@ initCoils = [1]
 initInputs = [1]
 initRegs = [0] * 2
 
+# integer indexes of the named values, to avoid the map lookups on hot paths
+CMD = coilMap['CMD']
+HCL = inputMap['HCL']
+H_CONCENTRATION = registerMap['H-CONCENTRATION']
+HCL_CONCENTRATION = registerMap['HCL-CONCENTRATION']
+
 
 class TankStateClass:
+    # every instance owns its own compact int64 arrays (like TankBatchClass), indexed by the maps above
+    __slots__ = ('coils', 'inputs', 'registers')
+
     def __init__(self):
-        # self.h_concentration = 0
-        # self.hcl_concentration = 0
-        self.tankState = {'coils':initCoils, 'inputs':initInputs, 'registers':initRegs}
+        self.coils = array('q', initCoils)
+        self.inputs = array('q', initInputs)
+        self.registers = array('q', initRegs)
+
+    def copy(self):
+        tank = TankStateClass.__new__(TankStateClass)
+        tank.coils = self.coils[:]
+        tank.inputs = self.inputs[:]
+        tank.registers = self.registers[:]
+        return tank
+
+    def snapshot(self):
+        """Return the whole state as an immutable tuple (coils, inputs, registers)."""
+        return (tuple(self.coils), tuple(self.inputs), tuple(self.registers))
+
+    def restore(self, snapshot):
+        self.coils[:] = array('q', map(int, snapshot[0]))
+        self.inputs[:] = array('q', map(int, snapshot[1]))
+        self.registers[:] = array('q', map(int, snapshot[2]))
     
     def set_hcl_input(self, hcl):
-        self.tankState['inputs'][inputMap['HCL']] = hcl
+        self.inputs[HCL] = int(hcl)
     
     def set_client_cmd_coil(self, cmd):
-        self.tankState['coils'][coilMap['CMD']] = cmd
+        self.coils[CMD] = int(cmd)
 
     def set_h_concentration(self, h_concentration):
-        self.tankState['registers'][registerMap['H-CONCENTRATION']] = h_concentration
+        self.registers[H_CONCENTRATION] = int(h_concentration)
 
     def set_hcl_concentration(self, hcl_concentration):
-        self.tankState['registers'][registerMap['HCL-CONCENTRATION']] = hcl_concentration
+        self.registers[HCL_CONCENTRATION] = int(hcl_concentration)
     
     def get_concentrations(self):
-        return (self.tankState['registers'][registerMap['H-CONCENTRATION']], self.tankState['registers'][registerMap['HCL-CONCENTRATION']])
+        return (self.registers[H_CONCENTRATION], self.registers[HCL_CONCENTRATION])
 
     def get_tank_state(self):
-        return self.tankState
+        # a plain-list copy, in the layout the datastore and callers expect
+        return {'coils': self.coils.tolist(), 'inputs': self.inputs.tolist(), 'registers': self.registers.tolist()}
 
 
     def predict_next_state(self, inputRate, dilutionRate, updateRate):
-        hcl_input = self.tankState['coils'][coilMap['CMD']]
-        hclConcentration = self.tankState['registers'][registerMap['HCL-CONCENTRATION']]
-
-        if hcl_input:
-            hclConcentration += int(inputRate * updateRate)
-            
-        hConcentration = self.tankState['registers'][registerMap['H-CONCENTRATION']] + int(dissociationRate * updateRate * hclConcentration)
-        hclConcentration = int((1 - dissociationRate * updateRate) * hclConcentration)
-
-        hConcentration = int((1 - dilutionRate * updateRate)*hConcentration + dilutionRate * updateRate * dilution_h_concentration)
-        hclConcentration = int((1 - dilutionRate * updateRate) * hclConcentration)
-
-        return (hConcentration, hclConcentration)
+        return step_concentrations(self.registers[H_CONCENTRATION], self.registers[HCL_CONCENTRATION],
+                                   self.coils[CMD], inputRate, dilutionRate, updateRate)
+
+    def predict_k_steps(self, k, inputRate, dilutionRate, updateRate, cmd=None, exact=False):
+        """Predict the concentrations k updates ahead with the pump held at cmd.
+
+        cmd defaults to the current client command coil. With exact=False the
+        affine dynamics (without int truncation) are composed in O(log k) and
+        floats are returned. With exact=True the integer path of update_state
+        is reproduced exactly by walking at most k updates of the integer orbit.
+        """
+        assert k >= 0, "k should be non-negative"
+        cmd = self._prediction_cmd(cmd)
+        h, hcl = self.get_concentrations()
+        if exact:
+            return integer_trajectory(h, hcl, cmd, inputRate, dilutionRate, updateRate, k, k)[0]
+
+        m = affine_power(affine_step_matrix(cmd, inputRate, dilutionRate, updateRate), k)
+        return (m[0][0] * h + m[0][1] * hcl + m[0][2], m[1][1] * hcl + m[1][2])
+
+    def predict_trajectory(self, steps, inputRate, dilutionRate, updateRate, cmd=None):
+        """Return the exact integer concentrations for the next `steps` updates.
+
+        The result is a list of (hConcentration, hclConcentration) tuples, one
+        per update, with the pump held at cmd (default: current command coil).
+        """
+        cmd = self._prediction_cmd(cmd)
+        h, hcl = self.get_concentrations()
+        return integer_trajectory(h, hcl, cmd, inputRate, dilutionRate, updateRate, 1, steps)
+
+    def predict_steps_to_threshold(self, threshold, inputRate, dilutionRate, updateRate, cmd=None, above=True, horizon=None):
+        """Return the number of updates until the H concentration crosses threshold.
+
+        With above=True this is the first update with H > threshold, otherwise
+        the first with H < threshold. Returns None if it never happens (or not
+        within horizon updates).
+        """
+        cmd = self._prediction_cmd(cmd)
+        h, hcl = self.get_concentrations()
+        limit = ORBIT_LIMIT if horizon is None else horizon
+        orbit, cycleStart = integer_orbit(h, hcl, cmd, inputRate, dilutionRate, updateRate, limit)
+        # the orbit holds the transient and one full cycle (after that it repeats), or stops at limit
+        for k in range(1, len(orbit)):
+            if horizon is not None and k > horizon:
+                break
+            if (orbit[k][0] > threshold) if above else (orbit[k][0] < threshold):
+                return k
+        return None
+
+    def _prediction_cmd(self, cmd):
+        if cmd is None:
+            cmd = self.coils[CMD]
+        return 1 if cmd else 0
 
     def update_state(self, inputRate, dilutionRate, updateRate):
-        self.tankState['inputs'][inputMap['HCL']] = self.tankState['coils'][coilMap['CMD']]
-
-        if self.tankState['inputs'][inputMap['HCL']]:
-            self.tankState['registers'][registerMap['HCL-CONCENTRATION']] += int(inputRate * updateRate)
-
-        self.tankState['registers'][registerMap['H-CONCENTRATION']] += int(dissociationRate * updateRate * self.tankState['registers'][registerMap['HCL-CONCENTRATION']])
-        self.tankState['registers'][registerMap['HCL-CONCENTRATION']]  = int((1 - dissociationRate * updateRate) * self.tankState['registers'][registerMap['HCL-CONCENTRATION']])
-
-        self.tankState['registers'][registerMap['H-CONCENTRATION']] = int((1 - dilutionRate * updateRate)*self.tankState['registers'][registerMap['H-CONCENTRATION']] + \
-                                                                          dilutionRate * updateRate * dilution_h_concentration)
-        self.tankState['registers'][registerMap['HCL-CONCENTRATION']] = int((1 - dilutionRate * updateRate) * self.tankState['registers'][registerMap['HCL-CONCENTRATION']])
-
-        return (self.tankState['registers'][registerMap['H-CONCENTRATION']], self.tankState['registers'][registerMap['HCL-CONCENTRATION']])
+        registers = self.registers
+        self.inputs[HCL] = self.coils[CMD]
+
+        registers[H_CONCENTRATION], registers[HCL_CONCENTRATION] = step_concentrations(
+            registers[H_CONCENTRATION], registers[HCL_CONCENTRATION], self.inputs[HCL], inputRate, dilutionRate, updateRate)
+
+        return (registers[H_CONCENTRATION], registers[HCL_CONCENTRATION])
+
+    def advance_state(self, k, inputRate, dilutionRate, updateRate):
+        """Apply update_state k times, with the command coil held, through the integer orbit."""
+        assert k >= 0, "k should be non-negative"
+        if k == 0:
+            return self.get_concentrations()
+        registers = self.registers
+        self.inputs[HCL] = self.coils[CMD]
+        registers[H_CONCENTRATION], registers[HCL_CONCENTRATION] = self.predict_k_steps(
+            k, inputRate, dilutionRate, updateRate, exact=True)
+
+        return (registers[H_CONCENTRATION], registers[HCL_CONCENTRATION])
+
+
+def step_concentrations(hConcentration, hclConcentration, hcl_input, inputRate, dilutionRate, updateRate):
+    """One update of the tank dynamics, truncated exactly like update_state."""
+    if hcl_input:
+        hclConcentration += int(inputRate * updateRate)
+
+    hConcentration = hConcentration + int(dissociationRate * updateRate * hclConcentration)
+    hclConcentration = int((1 - dissociationRate * updateRate) * hclConcentration)
+
+    hConcentration = int((1 - dilutionRate * updateRate)*hConcentration + dilutionRate * updateRate * dilution_h_concentration)
+    hclConcentration = int((1 - dilutionRate * updateRate) * hclConcentration)
+
+    return (hConcentration, hclConcentration)
+
+
+# Without the int() truncation one update is the affine map x' = A x + b on
+# x = (hConcentration, hclConcentration). It is kept as a 3x3 homogeneous
+# matrix so k updates compose by repeated squaring.
+def affine_step_matrix(cmd, inputRate, dilutionRate, updateRate):
+    inflow = int(inputRate * updateRate) if cmd else 0
+    d = dissociationRate * updateRate
+    keepR = 1 - dilutionRate * updateRate
+    return [[keepR, keepR * d, keepR * d * inflow + dilutionRate * updateRate * dilution_h_concentration],
+            [0.0, keepR * (1 - d), keepR * (1 - d) * inflow],
+            [0.0, 0.0, 1.0]]
+
+
+def affine_compose(a, b):
+    return [[sum(a[i][j] * b[j][k] for j in range(3)) for k in range(3)] for i in range(3)]
+
+
+def affine_power(m, k):
+    result = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    while k:
+        if k & 1:
+            result = affine_compose(m, result)
+        m = affine_compose(m, m)
+        k >>= 1
+    return result
+
+
+ORBIT_LIMIT = 100000     # most updates walked when no step count bounds the search
+CACHED_ORBIT = 1000      # only orbits that close within this many updates are cached
+ORBIT_CACHE = 256        # cached orbits, least recently used dropped first
+
+_orbits = OrderedDict()
+
+def integer_orbit(hConcentration, hclConcentration, cmd, inputRate, dilutionRate, updateRate, limit=ORBIT_LIMIT):
+    """Exact integer trajectory from a state until it repeats, for at most limit updates.
+
+    Returns (orbit, cycleStart): orbit[0] is the starting state and the
+    states from orbit[cycleStart] on repeat forever. cycleStart is None if no
+    repeat shows up within limit updates (slow dilution, diverging
+    parameters); orbit then holds the states after 0..limit updates. With
+    fast dilution the truncated dynamics settle on a fixed point (or a short
+    cycle) quickly; those orbits are cached per state and parameters, so a
+    later prediction from the same state is a lookup.
+    """
+    key = (hConcentration, hclConcentration, cmd, inputRate, dilutionRate, updateRate)
+    cached = _orbits.get(key)
+    if cached is not None:
+        _orbits.move_to_end(key)
+        return cached
+
+    state = (hConcentration, hclConcentration)
+    orbit = [state]
+    seen = {state: 0}
+    while len(orbit) <= limit:
+        state = step_concentrations(state[0], state[1], cmd, inputRate, dilutionRate, updateRate)
+        if state in seen:
+            result = (tuple(orbit), seen[state])
+            if len(orbit) <= CACHED_ORBIT:
+                _orbits[key] = result
+                if len(_orbits) > ORBIT_CACHE:
+                    _orbits.popitem(last=False)
+            return result
+        seen[state] = len(orbit)
+        orbit.append(state)
+    return (tuple(orbit), None)
+
+
+def integer_trajectory(hConcentration, hclConcentration, cmd, inputRate, dilutionRate, updateRate, first, last):
+    """Exact integer states after first..last updates, from the orbit walked at most last updates."""
+    orbit, cycleStart = integer_orbit(hConcentration, hclConcentration, cmd, inputRate, dilutionRate, updateRate, last)
+    if cycleStart is not None:
+        period = len(orbit) - cycleStart
+        return [orbit[k] if k < len(orbit) else orbit[cycleStart + (k - cycleStart) % period]
+                for k in range(first, last + 1)]
+
+    # no repeat within last updates: the orbit holds every state up to there
+    return list(orbit[first:last + 1])
@@ -0,0 +1,138 @@
+"""Buffered telemetry rows written from a background thread.
+
+The client and the MITM log one row per sample. Opening the CSV for every
+row costs an open/close pair on the event loop per sample; TelemetryWriter
+instead queues rows in memory and a writer thread hands them to the sink in
+batches, when batch_size rows are pending or every flush_interval seconds.
+
+Pending rows are flushed by close(), which is registered with atexit, so a
+sys.exit() from the detector path (or the end of asyncio.run) still gets
+every row on disk. atexit does not run when a signal kills the process, so
+the first writer also turns SIGTERM (what data.sh and orchestrate.py stop
+the scripts with) into a SystemExit, unless the script handles SIGTERM
+itself. A SIGKILL or a crash of the interpreter still loses the rows of up
+to one flush interval.
+
+The sink is a CSV file or, with format 'columnar', a ts_store directory
+that the plotter and analysis tools can memory map instead of parsing.
+
+usage::
+
+    telemetry = TelemetryWriter(open_sink("data/ph_data", dtDict.telemetry))
+    telemetry.write([current_time, pH_value, pump_state])
+"""
+import atexit
+import csv
+import logging
+import signal
+import threading
+
+from ts_store import ColumnarSink, PH_COLUMNS, RESIDUAL_COLUMNS
+
+
+_logger = logging.getLogger(__file__)
+
+PH_HEADER = ["Time (s)", "actual_pH", "HCl_pump_state"]
+RESIDUAL_HEADER = ["Time (s)", "actual_H", "predicted_H", "actual_HCl", "predicted_HCl"]
+TELEMETRY_FORMATS = ('csv', 'columnar')
+
+
+class CsvSink:
+    """CSV file truncated on open, header first."""
+    def __init__(self, path, header):
+        self.file = open(path, mode="w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+        self.file.flush()
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_sink(basename, format='csv', header=PH_HEADER, columns=PH_COLUMNS):
+    """basename.csv, or the store directory basename.ts for format 'columnar'."""
+    assert format in TELEMETRY_FORMATS, "telemetry should be one of {}".format(TELEMETRY_FORMATS)
+    assert len(header) == len(columns), "header and columns should describe the same rows"
+    if format == 'columnar':
+        return ColumnarSink(basename + ".ts", columns)
+    return CsvSink(basename + ".csv", header)
+
+
+def exit_on_sigterm():
+    """Exit through SystemExit on SIGTERM, so atexit handlers run; no-op if SIGTERM is already handled."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _raise_exit)
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+class TelemetryWriter:
+    def __init__(self, sink, batch_size=256, flush_interval=1.0):
+        assert batch_size > 0, "batch_size should be positive"
+        assert flush_interval > 0.0, "flush_interval should be positive"
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = []
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()     # keeps batches in order
+        self.closed = False
+        self.rows = 0
+
+        self.thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        exit_on_sigterm()
+
+    def write(self, row):
+        """Queue one row; never blocks on the file."""
+        with self.condition:
+            assert not self.closed, "telemetry writer is closed"
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def flush(self):
+        """Write every pending row now, from the calling thread."""
+        with self.write_lock:
+            with self.condition:
+                rows, self.pending = self.pending, []
+            self._write(rows)
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+        self.sink.close()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            self.sink.write_rows(rows)
+            self.rows += len(rows)
+        except OSError as e:
+            _logger.error("telemetry: dropped %d rows: %s", len(rows), e)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from detector import StreamingDetector, EwmaDetector, TwoSidedCusumDetector, PageHinkleyDetector, ChiSquareDetector
+
+
+DETECTORS = {
+    'ewma': lambda streams: EwmaDetector(lam=0.25, threshold=60.5, streams=streams),
+    'ewma_no_memory': lambda streams: EwmaDetector(lam=1.0, threshold=60.5, streams=streams),
+    'cusum': lambda streams: TwoSidedCusumDetector(drift=20, threshold=300.5, streams=streams),
+    'page_hinkley': lambda streams: PageHinkleyDetector(delta=5, threshold=400.5, streams=streams),
+    'chi_square': lambda streams: ChiSquareDetector(window=5, threshold=12000.5, sigma=1.0, streams=streams),
+    'chi_square_window_1': lambda streams: ChiSquareDetector(window=1, threshold=2500.5, streams=streams),
+}
+
+
+def make_residuals(seed, n, streams):
+    rng = np.random.default_rng(seed)
+    residuals = rng.integers(-30, 31, (n, streams))
+    # a biased stretch per stream, so the statistics rise and fall back
+    for s in range(streams):
+        start = rng.integers(0, n - 60)
+        residuals[start:start + 60, s] += rng.integers(40, 80)
+    return residuals
+
+
+@pytest.mark.parametrize("name", sorted(DETECTORS))
+def test_detect_many_matches_detect_across_chunks(name, monkeypatch):
+    monkeypatch.setattr(StreamingDetector, 'CHUNK', 7)
+    streams, n = 3, 400
+    residuals = make_residuals(1, n, streams)
+    predicted = np.full((n, streams), 10000)
+    actual = predicted + residuals
+
+    expected = np.zeros((n, streams), dtype=bool)
+    for s in range(streams):
+        single = DETECTORS[name](1)
+        expected[:, s] = [single.detect(int(a), int(p)) for a, p in zip(actual[:, s], predicted[:, s])]
+    assert expected.any() and not expected.all()
+
+    # uneven pieces, some shorter and some longer than a chunk
+    many = DETECTORS[name](streams)
+    pieces = [0, 1, 5, 7, 8, 30, 31, 200, n]
+    alarms = np.concatenate([many.detect_many(actual[a:b], predicted[a:b]) for a, b in zip(pieces, pieces[1:])])
+    assert alarms.shape == (n, streams)
+    assert (alarms == expected).all()
+    assert many.samples == n
+
+
+@pytest.mark.parametrize("name", sorted(DETECTORS))
+def test_one_dimensional_input_keeps_its_shape(name):
+    residuals = make_residuals(2, 200, 1)[:, 0]
+    single = DETECTORS[name](1)
+    expected = [single.detect_residual(float(r)) for r in residuals]
+    alarms = DETECTORS[name](1).detect_many(residuals, np.zeros_like(residuals))
+    assert alarms.shape == (200,)
+    assert alarms.tolist() == expected
+
+
+def test_a_detector_without_update_cannot_be_created():
+    class Incomplete(StreamingDetector):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete(threshold=1)
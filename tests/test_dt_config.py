@@ -0,0 +1,34 @@
+import json
+import os
+
+import pytest
+
+from dt_config import ConfigWatcher
+
+
+def write(path, values, mtime_ns):
+    path.write_text(json.dumps(values))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_a_bad_reload_keeps_the_last_good_config(tmp_path, caplog):
+    path = tmp_path / "dt.json"
+    write(path, {'inputRate': 7000, 'dilutionRate': 0.3}, 10**18)
+    watcher = ConfigWatcher(str(path))
+    good = watcher.get()
+
+    write(path, {'inputRate': -1, 'dilutionRate': 0.3}, 2 * 10**18)
+    for _ in range(5):
+        assert watcher.get() is good
+    # reported once, not on every get()
+    assert len([r for r in caplog.records if "ignoring invalid config" in r.getMessage()]) == 1
+
+    write(path, {'inputRate': 6000, 'dilutionRate': 0.3}, 3 * 10**18)
+    assert watcher.get().inputRate == 6000
+
+
+def test_a_bad_first_load_raises(tmp_path):
+    path = tmp_path / "dt.json"
+    path.write_text("{")
+    with pytest.raises(ValueError):
+        ConfigWatcher(str(path))
@@ -0,0 +1,50 @@
+import struct
+
+import pytest
+
+from mbap_framer import MbapFramer
+
+
+def frame(transaction, pdu, unit=1):
+    return struct.pack('>HHHB', transaction, 0, len(pdu) + 1, unit) + pdu
+
+
+FRAMES = [frame(1, b'\x03\x00\x00\x00\x02'), frame(2, b'\x03\x04\x00\x07\x00\x08'), frame(3, b'\x05\x00\x01\xff\x00'),
+          frame(4, b'\x03' + bytes(252))]
+STREAM = b''.join(FRAMES)
+
+
+def test_byte_by_byte():
+    framer = MbapFramer()
+    received = []
+    for i in range(len(STREAM)):
+        received += framer.feed(STREAM[i:i + 1])
+        assert framer.pending() == len(STREAM[:i + 1]) - sum(map(len, received))
+    assert received == FRAMES
+    assert framer.pending() == 0
+
+
+@pytest.mark.parametrize("cut", [1, 6, 7, 12, 13, 20, len(STREAM) - 1])
+def test_coalesced_frames_and_a_partial_one(cut):
+    framer = MbapFramer()
+    first = framer.feed(STREAM[:cut])
+    second = framer.feed(STREAM[cut:])
+    assert first + second == FRAMES
+    assert first == [f for f in FRAMES if STREAM.index(f) + len(f) <= cut]
+    assert framer.pending() == 0
+
+
+def test_empty_read():
+    framer = MbapFramer()
+    assert framer.feed(STREAM[:3]) == []
+    assert framer.feed(b'') == []
+    assert framer.pending() == 3
+
+
+@pytest.mark.parametrize("bad", [struct.pack('>HHHB', 1, 1, 6, 1), struct.pack('>HHHB', 1, 0, 1, 1),
+                                 struct.pack('>HHHB', 1, 0, 255, 1)])
+def test_not_modbus_tcp(bad):
+    framer = MbapFramer()
+    assert framer.feed(FRAMES[0]) == [FRAMES[0]]
+    with pytest.raises(ValueError):
+        framer.feed(bad)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from detector import StatefulDetector, StatelessDetector, EwmaDetector
+from replay import replay, residuals
+from sweep import sweep
+
+
+def make_trace(seed=0, n=2000):
+    rng = np.random.default_rng(seed)
+    actual = rng.integers(9000, 11000, n)
+    # quiet stretches and bursts, so alarms start, stop and start again
+    noise = rng.integers(-40, 41, n) * (rng.random(n) < 0.7) + rng.integers(-900, 901, n) * (rng.random(n) < 0.05)
+    predicted = actual + noise
+    return {'time': np.arange(n) * 1.0 + 100.0, 'actualH': actual, 'predictedH': predicted,
+            'actualHCl': actual, 'predictedHCl': actual}
+
+
+def scalar_stateful(trace, threshold, delta):
+    detector = StatefulDetector(threshold = threshold)
+    detector.set_delta(delta)
+    alarms = [i for i, (a, p) in enumerate(zip(trace['actualH'].tolist(), trace['predictedH'].tolist()))
+              if detector.detect(a, p)]
+    return alarms, detector.get_deviation()
+
+
+@pytest.mark.parametrize("delta", [0, 20, 40, 100])
+def test_replay_matches_stateful_detect(delta):
+    trace = make_trace()
+    detector = StatefulDetector(threshold = 2000)
+    detector.set_delta(delta)
+    result = replay(trace, detector)
+    alarms, deviation = scalar_stateful(trace, 2000, delta)
+    assert result.alarms.tolist() == alarms
+    assert result.deviation == deviation
+
+
+def test_replay_matches_stateless_detect():
+    trace = make_trace(1)
+    detector = StatelessDetector(threshold = 500)
+    result = replay(trace, detector)
+    assert result.alarms.tolist() == [i for i, (a, p) in enumerate(zip(trace['actualH'], trace['predictedH']))
+                                      if StatelessDetector(threshold = 500).detect(a, p)]
+
+
+def test_replay_of_a_streaming_detector_matches_detect():
+    trace = make_trace(2)
+    result = replay(trace, EwmaDetector(lam=0.3, threshold=150.5))
+    single = EwmaDetector(lam=0.3, threshold=150.5)
+    assert result.alarms.tolist() == [i for i, (a, p) in enumerate(zip(trace['actualH'], trace['predictedH']))
+                                      if single.detect(a, p)]
+
+
+def test_stateful_detect_many_matches_detect():
+    trace = make_trace(3)
+    many = StatefulDetector(threshold = 2000)
+    many.set_delta(20)
+    alarms = np.concatenate([many.detect_many(trace['actualH'][i:i + 333], trace['predictedH'][i:i + 333])
+                             for i in range(0, len(trace['time']), 333)])
+    expected, deviation = scalar_stateful(trace, 2000, 20)
+    assert np.flatnonzero(alarms).tolist() == expected
+    assert many.get_deviation() == deviation
+
+
+def test_sweep_matches_stateful_detect_over_the_grid():
+    trace = make_trace(4)
+    deltas, thresholds = [0, 20, 40, 100], [500, 2000, 10000]
+    result = sweep(residuals(trace), deltas, thresholds, trace['time'])
+    for i, delta in enumerate(deltas):
+        for j, threshold in enumerate(thresholds):
+            alarms, deviation = scalar_stateful(trace, threshold, delta)
+            first = alarms[0] if alarms else len(trace['time'])
+            assert result.first_alarm[i, j] == first
+            assert result.deviation[i, j] == deviation
+            if alarms:
+                assert result.detection_time[i, j] == trace['time'][first]
+            else:
+                assert np.isnan(result.detection_time[i, j])
@@ -0,0 +1,51 @@
+import numpy as np
+
+from tank_batch import TankBatchClass
+from tank_state import TankStateClass
+
+
+INPUT_RATES = [7000, 5000, 123.4]
+DILUTION_RATES = [0.3, 0.2, 0.45]
+UPDATE = 0.1
+
+
+def scalar_tanks(h, hcl, cmd):
+    tanks = []
+    for i in range(len(h)):
+        tank = TankStateClass()
+        tank.set_client_cmd_coil(cmd[i])
+        tank.set_h_concentration(h[i])
+        tank.set_hcl_concentration(hcl[i])
+        tanks.append(tank)
+    return tanks
+
+
+def test_run_matches_update_state():
+    h, hcl, cmd = [10000, 9000, 12000], [0, 100, 5000], [1, 0, 1]
+    batch = TankBatchClass(INPUT_RATES, DILUTION_RATES, UPDATE, h, hcl, cmd)
+    hTraj, hclTraj = batch.run(300)
+
+    for i, tank in enumerate(scalar_tanks(h, hcl, cmd)):
+        expected = [tank.update_state(INPUT_RATES[i], DILUTION_RATES[i], UPDATE) for _ in range(300)]
+        assert hTraj[:, i].tolist() == [e[0] for e in expected]
+        assert hclTraj[:, i].tolist() == [e[1] for e in expected]
+
+
+def test_run_follows_a_cmd_schedule():
+    rng = np.random.default_rng(0)
+    h, hcl, cmd = [10000, 9000, 12000], [0, 100, 5000], [1, 1, 1]
+    schedule = rng.integers(0, 2, (200, 3)).astype(bool)
+    batch = TankBatchClass(INPUT_RATES, DILUTION_RATES, UPDATE, h, hcl, cmd)
+    hTraj, hclTraj = batch.run(200, schedule)
+
+    for i, tank in enumerate(scalar_tanks(h, hcl, cmd)):
+        for t in range(200):
+            tank.set_client_cmd_coil(int(schedule[t, i]))
+            assert tank.update_state(INPUT_RATES[i], DILUTION_RATES[i], UPDATE) == (hTraj[t, i], hclTraj[t, i])
+
+
+def test_from_tanks_and_get_tank_round_trip():
+    tanks = scalar_tanks([10000, 9000], [0, 100], [1, 0])
+    batch = TankBatchClass.from_tanks(tanks, 7000, 0.3, UPDATE)
+    for i, tank in enumerate(tanks):
+        assert batch.get_tank(i).snapshot()[0::2] == tank.snapshot()[0::2]
@@ -0,0 +1,67 @@
+import pytest
+
+from tank_state import TankStateClass
+
+
+RATES = (7000, 0.3, 0.1)
+
+
+def tank(h=10000, hcl=0, cmd=1):
+    t = TankStateClass()
+    t.set_client_cmd_coil(cmd)
+    t.set_h_concentration(h)
+    t.set_hcl_concentration(hcl)
+    return t
+
+
+def iterated(t, k):
+    t = t.copy()
+    for _ in range(k):
+        t.update_state(*RATES)
+    return t.get_concentrations()
+
+
+@pytest.mark.parametrize("cmd", [0, 1])
+@pytest.mark.parametrize("k", [0, 1, 2, 7, 50, 500, 5000])
+def test_exact_k_step_prediction_matches_iterated_updates(cmd, k):
+    t = tank(10321, 77, cmd)
+    assert t.predict_k_steps(k, *RATES, exact=True) == iterated(t, k)
+
+
+def test_trajectory_and_advance_state_match_iterated_updates():
+    t = tank(9000, 2500, 1)
+    trajectory = t.predict_trajectory(300, *RATES)
+    assert trajectory == [iterated(t, k) for k in range(1, 301)]
+
+    advanced = t.copy()
+    assert advanced.advance_state(123, *RATES) == iterated(t, 123)
+    assert advanced.inputs[0] == 1
+
+
+def test_affine_prediction_stays_close_to_the_integer_path():
+    t = tank(10000, 0, 1)
+    h, hcl = t.predict_k_steps(40, *RATES)
+    exact = iterated(t, 40)
+    # the truncations lose less than one unit per update and term
+    assert abs(h - exact[0]) < 40 * 3 and abs(hcl - exact[1]) < 40 * 3
+
+
+def test_setters_accept_floats():
+    t = tank(10000.0, 5.0, True)
+    assert t.get_concentrations() == (10000, 5)
+    assert t.predict_k_steps(3, *RATES, exact=True) == iterated(t, 3)
+
+
+def test_slow_dilution_walks_only_the_steps_asked_for():
+    import tank_state
+    slow = (7000, 0.001, 0.01)
+    t = tank(10321, 77, 1)
+    cached = len(tank_state._orbits)
+    for h in range(10000, 10050):
+        t.set_h_concentration(h)
+        expected = t.copy()
+        expected.update_state(*slow)
+        assert t.predict_k_steps(1, *slow, exact=True) == expected.get_concentrations()
+        assert t.predict_steps_to_threshold(10**9, *slow, horizon=10) is None
+    # orbits that did not close are not kept
+    assert len(tank_state._orbits) == cached
@@ -0,0 +1,42 @@
+import os
+import signal
+import subprocess
+import sys
+
+from telemetry import TelemetryWriter, CsvSink, PH_HEADER
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WRITER = """
+import sys, time
+from telemetry import TelemetryWriter, open_sink
+telemetry = TelemetryWriter(open_sink(sys.argv[1]), batch_size=10**6, flush_interval=3600.0)
+for i in range(100):
+    telemetry.write([i, 7.0, 1])
+print("ready", flush=True)
+time.sleep(60)
+"""
+
+
+def test_close_writes_every_row(tmp_path):
+    path = tmp_path / "ph_data.csv"
+    telemetry = TelemetryWriter(CsvSink(str(path), PH_HEADER), batch_size=1000, flush_interval=3600.0)
+    for i in range(10):
+        telemetry.write([i, 7.0, 1])
+    telemetry.close()
+    assert path.read_text().splitlines()[1:] == ["{},7.0,1".format(i) for i in range(10)]
+
+
+def test_sigterm_flushes_pending_rows(tmp_path):
+    basename = str(tmp_path / "ph_data")
+    process = subprocess.Popen([sys.executable, "-c", WRITER, basename], cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    try:
+        assert process.stdout.readline().strip() == "ready"
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 128 + signal.SIGTERM
+    finally:
+        process.kill()
+        process.stdout.close()
+    with open(basename + ".csv") as rf:
+        assert len(rf.read().splitlines()) == 1 + 100
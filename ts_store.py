@@ -0,0 +1,161 @@
+"""Append-only binary columnar time-series store.
+
+A store is a directory with one file of fixed-width little-endian values per
+column, plus a sparse time index:
+
+    meta.json     column names and dtypes, rows per index block
+    time.bin      float64 timestamps, nondecreasing (both clocks are)
+    pH.bin        float64
+    pump.bin      uint8
+    index.bin     float64 first timestamp of every BLOCK_ROWS rows
+
+Rows are only ever appended, so a reader never sees a row change. The reader
+maps the column files with numpy.memmap; slicing by time bisects the index,
+then the one block it points to, and returns views into the mapped files, so
+nothing is parsed or copied until the data is actually used.
+
+A row only counts once every column holds it, so a reader running next to
+the writer (or after a crash) ignores a partially written row.
+
+usage::
+
+    sink = ColumnarSink("data/ph_data.ts")          # a TelemetryWriter sink
+    sink.write_rows([[t, pH, pump], ...])
+
+    store = TimeSeriesStore("data/ph_data.ts")
+    window = store.slice(start, end)                # {'time': ..., 'pH': ..., 'pump': ...}
+"""
+import json
+import os
+
+import numpy as np
+
+
+PH_COLUMNS = (('time', '<f8'), ('pH', '<f8'), ('pump', 'u1'))
+# measured and predicted concentrations, for replaying detectors offline
+RESIDUAL_COLUMNS = (('time', '<f8'), ('actualH', '<i8'), ('predictedH', '<i8'),
+                    ('actualHCl', '<i8'), ('predictedHCl', '<i8'))
+BLOCK_ROWS = 4096
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.bin'
+
+
+def column_file(path, name):
+    return os.path.join(path, name + '.bin')
+
+
+class ColumnarSink:
+    """Appends rows to a store; same interface as telemetry.CsvSink."""
+    def __init__(self, path, columns=PH_COLUMNS, append=False, block_rows=BLOCK_ROWS):
+        assert columns[0][0] == 'time', "the first column should be the time"
+        self.path = path
+        self.columns = tuple((name, np.dtype(dtype)) for name, dtype in columns)
+        self.block_rows = block_rows
+        os.makedirs(path, exist_ok=True)
+
+        mode = 'ab' if append else 'wb'
+        if append and os.path.exists(os.path.join(path, META_FILE)):
+            store = TimeSeriesStore(path)
+            assert [(name, store.dtypes[name]) for name, _ in self.columns] == list(self.columns), \
+                "columns should match the existing store"
+            self.block_rows = store.block_rows
+            self.rows = len(store)
+            self.last_time = store.time_range()[1] if self.rows else -np.inf
+            # drop a partially written row so every column lines up again
+            for name, dtype in self.columns:
+                with open(column_file(path, name), 'r+b') as f:
+                    f.truncate(self.rows * dtype.itemsize)
+            with open(os.path.join(path, INDEX_FILE), 'r+b') as f:
+                f.truncate(-(-self.rows // self.block_rows) * 8)
+        else:
+            self.rows = 0
+            self.last_time = -np.inf
+
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump({'columns': [[name, dtype.str] for name, dtype in self.columns],
+                       'blockRows': self.block_rows}, f)
+        self.files = [open(column_file(path, name), mode) for name, _ in self.columns]
+        self.index = open(os.path.join(path, INDEX_FILE), mode)
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        times = np.asarray([row[0] for row in rows], dtype=self.columns[0][1])
+        # the index relies on time order; a clock step backwards is clamped
+        times = np.maximum.accumulate(np.maximum(times, self.last_time))
+        self.last_time = times[-1]
+
+        for i, ((name, dtype), f) in enumerate(zip(self.columns, self.files)):
+            values = times if i == 0 else np.asarray([row[i] for row in rows], dtype=dtype)
+            f.write(values.tobytes())
+
+        # first timestamp of every block that starts in this batch
+        first = -(-self.rows // self.block_rows) * self.block_rows
+        self.index.write(times[first - self.rows::self.block_rows].tobytes())
+        self.rows += len(rows)
+        self.flush()
+
+    def flush(self):
+        for f in self.files + [self.index]:
+            f.flush()
+
+    def close(self):
+        for f in self.files + [self.index]:
+            f.close()
+
+
+class TimeSeriesStore:
+    """Read-only view of a store, columns memory mapped."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.block_rows = meta['blockRows']
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in meta['columns']}
+        self.names = [name for name, _ in meta['columns']]
+
+        sizes = [os.path.getsize(column_file(path, name)) // self.dtypes[name].itemsize for name in self.names]
+        self.rows = min(sizes)
+        self.columns = {name: self._map(column_file(path, name), self.dtypes[name], self.rows) for name in self.names}
+
+        blocks = -(-self.rows // self.block_rows)
+        indexPath = os.path.join(path, INDEX_FILE)
+        indexed = min(blocks, os.path.getsize(indexPath) // 8) if os.path.exists(indexPath) else 0
+        index = self._map(indexPath, np.dtype('<f8'), indexed)
+        if indexed < blocks:
+            # the writer stopped before writing these entries; read them from the time column
+            index = np.concatenate([index, self.columns['time'][indexed * self.block_rows::self.block_rows]])
+        self.index = index
+
+    @staticmethod
+    def _map(path, dtype, count):
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    def __len__(self):
+        return self.rows
+
+    def time_range(self):
+        if self.rows == 0:
+            return None
+        return float(self.columns['time'][0]), float(self.columns['time'][-1])
+
+    def search(self, t, side='left'):
+        """Row of time t as numpy.searchsorted would return it on the time column."""
+        # the last block starting before t (left) or at t (right) holds the answer,
+        # or it is the first row of the next block
+        block = max(int(np.searchsorted(self.index, t, side=side)) - 1, 0)
+        first = block * self.block_rows
+        last = min(first + self.block_rows, self.rows)
+        return first + int(np.searchsorted(self.columns['time'][first:last], t, side=side))
+
+    def rows_between(self, start=None, end=None):
+        first = 0 if start is None else self.search(start, 'left')
+        last = self.rows if end is None else self.search(end, 'right')
+        return first, max(first, last)
+
+    def slice(self, start=None, end=None):
+        """Columns of the rows with start <= time <= end, as views into the mapped files."""
+        first, last = self.rows_between(start, end)
+        return {name: column[first:last] for name, column in self.columns.items()}
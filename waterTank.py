@@ -38,8 +38,16 @@ import os
 import pdb
 import random
 import json
+import time
 import pymodbus
 from tank_state import *
+from tank_batch import TankBatchClass
+from sim_clock import RealClock, get_clock
+from dt_config import ConfigWatcher, tank_sections
+from scheduler import DeadlineScheduler
+from tank_datastore import TankDataBlock
+from metrics import MetricsRegistry, exponential_buckets, start_metrics_server
+from log_setup import setup_logging, set_log_mode, HotPath
 
 try:
     import server_async
@@ -54,13 +62,16 @@ from pymodbus.datastore import (
     ModbusServerContext,
     ModbusSlaveContext,
 )
+from pymodbus.server.async_io import _serverList
 
 _logger = logging.getLogger(__name__)
+hotPath = HotPath(_logger)
 
 dtDict = {}
 # tankState = {}
 argFile = ""
 slave_id = 0x00
+tankBlocks = {}         # slave id -> TankDataBlock holding that tank's register image
 
 # global for acess by both setup and update
 rd_reg_cnt = 2             # number of input registers used, CHANGED FOR PROJECT
@@ -81,6 +92,42 @@ global inputRate, dilutionRate, tankState
 inputRate = 0
 dilutionRate = 0 
 tankState = TankStateClass()
+clock = RealClock()     # replaced by the virtual clock when the config asks for it
+
+# fleet mode: when the config has a "tanks" list, every entry is one tank
+# served under its own slave id, and all of them advance in one batch
+global fleet, fleetSlaves, fleetConfig
+fleet = None
+fleetSlaves = []
+fleetConfig = None
+
+configWatcher = None
+
+# runtime metrics, served as Prometheus text when the config sets "metricsPort"
+metrics = MetricsRegistry()
+tickDuration = metrics.histogram('tank_tick_duration_seconds', 'Time to compute and publish one tick',
+                                 exponential_buckets(1e-5, 2, 22))
+tickLateness = metrics.histogram('tank_tick_lateness_seconds', 'How late each tick started',
+                                 exponential_buckets(1e-5, 2, 22))
+requestsServed = metrics.counter('tank_requests_total', 'Modbus requests received', label='function_code')
+datastoreRead = metrics.histogram('tank_datastore_read_seconds', 'Datastore read latency',
+                                  exponential_buckets(1e-7, 2, 24))
+datastoreWrite = metrics.histogram('tank_datastore_write_seconds', 'Datastore write latency',
+                                   exponential_buckets(1e-7, 2, 24))
+
+
+def connected_clients():
+    # pymodbus keeps no public handle on the running server, only this registry
+    active = getattr(_serverList, 'active_server', None)
+    if active is None:
+        return None
+    return len(getattr(active.server, 'active_connections', {}))
+
+metrics.gauge('tank_connected_clients', 'Open Modbus client connections', connected_clients)
+
+
+def trace_request(request, *addr):
+    requestsServed.inc(request.function_code)
 
 updates = 0
 def initDT(dtDict):
@@ -91,6 +138,10 @@ def initDT(dtDict):
 
     print(dtDict)
 
+    if 'tanks' in dtDict:
+        initFleet(dtDict)
+        return
+
     if 'inputRate' in dtDict:
         inputRate = dtDict['inputRate'] # Rate of HCl entering tank
 
@@ -148,36 +199,66 @@ def initDT(dtDict):
 
 
 
-def update_inputs(context):
-    global inputRate, dilutionRate, tankState
+def initFleet(dtDict):
+    global port, update
+    global fleet, fleetSlaves, fleetConfig
 
-    # print("Starting update_inputs")
-    
-    with open(argFile,'r') as rf:
-        dtDict = json.load(rf)
+    if 'port' in dtDict:
+        port = dtDict['port']
 
-    # print("Finished json load")
+    assert port==502 or 5000 < port < 10000, "port should either be 502 or in (5000,10000)"
 
-    if 'inputRate' in dtDict:
-        inputRate = dtDict['inputRate'] # Rate of HCl entering tank
+    # the tick period is shared, each tank integrates with its own "update"
+    if 'update' in dtDict:
+        update = dtDict['update']
 
-    assert inputRate > 0.0, "inputRate should be positive"
+    assert 0.0 < update < 10.0, "update should be positive and less than 10 seconds"
 
-    if 'dilutionRate' in dtDict:
-        dilutionRate = dtDict['dilutionRate'] # Rate of water entering tank
+    sections = tank_sections(dtDict)
 
-    assert dilutionRate > 0.0, "dilutionRate should be positive"
+    fleetSlaves = [section['slave'] for section in sections]
+    assert len(set(fleetSlaves)) == len(fleetSlaves), "tank slave ids should be unique"
+    assert all(1 <= slave <= 247 for slave in fleetSlaves), "tank slave ids should be in [1, 247]"
 
-    if 'HCl' in dtDict:
-        hcl = dtDict['HCl'] # Toggle if HCL is entering system
+    fleet = TankBatchClass(
+        [section['inputRate'] for section in sections],
+        [section['dilutionRate'] for section in sections],
+        [section.get('update', update) for section in sections],
+        [section.get('hConcentration', 0) for section in sections],
+        [section.get('hclConcentration', 0) for section in sections],
+        cmd=initCoils[coilMap['CMD']],
+    )
 
-    assert hcl == 0 or hcl == 1, "hcl pump can either be 0 or 1"
-    # print("Finished hcl")
+    fleetConfig = dtDict
 
+    print("Fleet of {} tanks on slave ids {}".format(len(fleet), fleetSlaves))
 
-    tankState.set_hcl_input(1 if hcl else 0)
 
-    # print("Finished update_inputs")
+def update_fleet_inputs():
+    global fleet, fleetConfig
+
+    config = configWatcher.get()
+    if config is fleetConfig:
+        return
+    fleetConfig = config
+
+    sections = tank_sections(config)
+    assert [section['slave'] for section in sections] == fleetSlaves, "tanks cannot be added or removed while running"
+
+    fleet.set_rates([section['inputRate'] for section in sections],
+                    [section['dilutionRate'] for section in sections])
+
+
+def update_inputs(context):
+    global inputRate, dilutionRate, tankState
+
+    # the watcher only re-reads and validates the file when it changed
+    config = configWatcher.get()
+
+    inputRate = config.inputRate # Rate of HCl entering tank
+    dilutionRate = config.dilutionRate # Rate of water entering tank
+
+    tankState.set_hcl_input(1 if config.HCl else 0)
 
 def update_tank_state(context):
     global inputRate, dilutionRate, tankState, update
@@ -215,59 +296,77 @@ async def updating_task(context):
     It should be noted that getValues and setValues are not safe
     against concurrent use.
     """
-    rd_reg_as_hex = 0x03 
-    rd_output_coil_as_hex = 0x01
-    rd_direct_input_as_hex = 0x02
-
     slave_id = 0x00
+    datablock = tankBlocks[slave_id]
 
     # print("Running updating_task")
     # print(type(context[slave_id]))
 
     # print("TESTING " + str(tankState.get_concentrations()))
 
+    # set values to initial values
+    datablock.publish_tank(tankState)
 
-
-    # set values to initial values. not sure why initial getValues is needed, but server_updating.py has it
-    context[slave_id].getValues(rd_reg_as_hex, rd_reg_address, count=len(tankState.get_tank_state()['registers']))
-    context[slave_id].setValues(rd_reg_as_hex, rd_reg_address, tankState.get_tank_state()['registers'])
-
-    context[slave_id].getValues(rd_output_coil_as_hex, rd_output_coil_address, count=len(tankState.get_tank_state()['coils']))
-    context[slave_id].setValues(rd_output_coil_as_hex, rd_output_coil_address, tankState.get_tank_state()['coils'])
-
-    context[slave_id].getValues(rd_direct_input_as_hex, rd_direct_input_address, count=len(tankState.get_tank_state()['inputs']))
-    context[slave_id].setValues(rd_direct_input_as_hex, rd_direct_input_address, tankState.get_tank_state()['inputs'])
-
+    # ticks are released on a fixed grid, so the work done in a tick does not stretch the period
+    scheduler = DeadlineScheduler(update * 10, clock, policy=configWatcher.get().catchUp)
 
     # incrementing loop
     while True:
 
         # print("Starting sleep")
-        await asyncio.sleep(update * 10)
+        lateness = await scheduler.wait()
+        tickLateness.observe(lateness)
+        tickStart = time.perf_counter()
+        _logger.debug("tick %d started %.6fs late", scheduler.ticks, lateness)
         # print("Finished sleep")
 
+        # fetch the coil written by the client from the data store
+        tankState.set_client_cmd_coil(datablock.get_coil())
 
+        update_tank_state(context)
+        hotPath("%s\n", tankState.get_tank_state())
 
-        # fetch the coil and direct inputs from the data store
-        coil_values  = context[slave_id].getValues(rd_output_coil_as_hex, rd_output_coil_address, count=len(tankState.get_tank_state()['coils']))
-        # print("coil values", coil_values[0])
-        tankState.set_client_cmd_coil(coil_values[0])
+        # the whole image (coil, pump input, registers) in one write, so
+        # readers never see a half-updated tank
+        datablock.publish_tank(tankState)
+        tickDuration.observe(time.perf_counter() - tickStart)
 
-        update_tank_state(context)
-        print(tankState.get_tank_state())
-        print("")
 
-        # input_values = context[slave_id].getValues(rd_direct_input_as_hex, rd_direct_input_address, count=len(tankState.get_tank_state()['inputs']))
 
-        # make the input_values reflect what is in tankState, as these are externally applied
-        # input_values[inputMap['HCL']] = tankState.get_tank_state()['inputs'][inputMap['HCL']]
+async def fleet_updating_task(context):
+    """Update every tank of the fleet in one vectorized tick.
 
-        # print("Finished setValues in updating_task")
+    Same datastore layout as updating_task, one TankDataBlock per slave id.
+    """
+    blocks = [tankBlocks[slave] for slave in fleetSlaves]
+
+    def publish_fleet():
+        cmd = fleet.cmd.tolist()
+        inputs = fleet.hclInput.tolist()
+        hConcentrations = fleet.h.tolist()
+        hclConcentrations = fleet.hcl.tolist()
+        for i, block in enumerate(blocks):
+            block.publish(block.make_image(cmd[i], inputs[i], [hConcentrations[i], hclConcentrations[i]]))
 
-        context[slave_id].setValues(rd_direct_input_as_hex, rd_direct_input_address, tankState.get_tank_state()['inputs'])
-        # context[slave_id].setValues(rd_output_coil_as_hex, rd_output_coil_address, tankState.get_tank_state()['coils'])
-        context[slave_id].setValues(rd_reg_as_hex, rd_reg_address, tankState.get_tank_state()['registers'])
+    publish_fleet()
 
+    scheduler = DeadlineScheduler(update * 10, clock, policy=configWatcher.get().catchUp)
+
+    while True:
+        lateness = await scheduler.wait()
+        tickLateness.observe(lateness)
+        tickStart = time.perf_counter()
+        _logger.debug("fleet tick %d started %.6fs late", scheduler.ticks, lateness)
+
+        cmd = [block.get_coil() for block in blocks]
+
+        update_fleet_inputs()
+        fleet.step(cmd)
+        hotPath("Fleet H concentration min %d max %d, pumps on %d/%d",
+                fleet.h.min(), fleet.h.max(), int(fleet.hclInput.sum()), len(fleet))
+
+        publish_fleet()
+        tickDuration.observe(time.perf_counter() - tickStart)
 
 
 def setup_updating_server(cmdline=None):
@@ -278,22 +377,47 @@ def setup_updating_server(cmdline=None):
     # This is because many devices exhibit this kind of behavior (but not all)
 
     # Continuing, use a sequential block 
-    datablock = ModbusSequentialDataBlock(0x00, [0]*(rd_reg_address+rd_reg_cnt))
-    context = ModbusSlaveContext(di=datablock, co=datablock, hr=datablock, ir=datablock)
-    context = ModbusServerContext(slaves=context, single=True)
-    return server_async.setup_server(
+    if fleet is not None:
+        # one block per tank, each reachable under its own slave id
+        slaves = {}
+        for slave in fleetSlaves:
+            datablock = TankDataBlock(rd_output_coil_address, rd_direct_input_address, rd_reg_address, rd_reg_cnt,
+                                      read_histogram=datastoreRead, write_histogram=datastoreWrite)
+            tankBlocks[slave] = datablock
+            slaves[slave] = ModbusSlaveContext(di=datablock, co=datablock, hr=datablock, ir=datablock)
+        context = ModbusServerContext(slaves=slaves, single=False)
+    else:
+        datablock = TankDataBlock(rd_output_coil_address, rd_direct_input_address, rd_reg_address, rd_reg_cnt,
+                                  read_histogram=datastoreRead, write_histogram=datastoreWrite)
+        tankBlocks[slave_id] = datablock
+        context = ModbusSlaveContext(di=datablock, co=datablock, hr=datablock, ir=datablock)
+        context = ModbusServerContext(slaves=context, single=True)
+    args = server_async.setup_server(
         description="Run asynchronous server.", context=context, cmdline=cmdline
     )
+    args.request_tracer = trace_request
+    return args
 
 
 async def run_updating_server(args):
     """Start updating_task concurrently with the current task."""
     # print("Starting updating_task")
-    task = asyncio.create_task(updating_task(args.context))
+    if fleet is not None:
+        task = asyncio.create_task(fleet_updating_task(args.context))
+    else:
+        task = asyncio.create_task(updating_task(args.context))
     # print("Finished updating_task")
     task.set_name("example updating task")
+
+    metricsServer = None
+    if configWatcher is not None and 'metricsPort' in configWatcher.get():
+        metricsServer = await start_metrics_server(metrics, configWatcher.get().get('metricsHost', '127.0.0.1'),
+                                                   configWatcher.get().metricsPort)
+
     await server_async.run_async_server(args)  # start the server
     task.cancel()
+    if metricsServer is not None:
+        metricsServer.close()
 
 
 async def main(cmdline=None):
@@ -304,18 +428,21 @@ async def main(cmdline=None):
 
 
 if __name__ == "__main__":
+    setup_logging('logs/water_tank.log')
     # first argument is name of file where digital twin arguments reside 
     if not len(sys.argv) < 2:
         #argFile = os.path.join('/tmp', sys.argv[1])
         argFile = os.path.join('.', sys.argv[1])
         try:
-            with open(argFile,'r') as rf:
-                dtDict = json.load(rf)
+            configWatcher = ConfigWatcher(argFile)
         except:
             print("error opening argument file {}\n".format(argFile))
             exit(1)
+        dtDict = configWatcher.get()
         sys.argv.pop(1)
 
     initDT(dtDict)
+    hotPath.production = set_log_mode(dtDict.logMode)
+    clock = get_clock(dtDict, 'tank')
     """Combine setup and run."""
-    asyncio.run(main(), debug=True)
\ No newline at end of file
+    asyncio.run(main(), debug=not hotPath.production)
\ No newline at end of file